@@ -11,19 +11,28 @@ import shlex
 import shutil
 import subprocess
 import sys
+import threading
+import time
+import concurrent.futures
 import xml.dom.minidom as minidom
 import xml.etree.ElementTree as ET
 from binascii import hexlify as hx, unhexlify as uhx
 from hashlib import sha256
 from struct import pack as pk, unpack as upk
-from io import TextIOWrapper
+from io import TextIOWrapper, BytesIO
 import Titles
+import cdn
 import requests
 import unidecode
 import urllib3
 import Print
 import Status
 import Config
+import Keys
+import Fs
+import Fs.Type
+from Fs.File import MemoryFile
+from Fs.Nca import NcaHeader
 
 #Global Vars
 titlekey_list = []
@@ -31,6 +40,10 @@ quiet = False
 truncateName = False
 enxhop = False
 
+class RangeIgnored(IOError):
+	# the server answered a ranged request with the whole file
+	pass
+
 def sha256_file(fPath):
 	f = open(fPath, 'rb')
 	fSize = os.path.getsize(fPath)
@@ -50,6 +63,17 @@ def sha256_file(fPath):
 	f.close()
 	return hash.hexdigest()
 
+def sha256_update(hash, fPath, start, end, chunkSize=0x100000):
+	# feeds bytes start..end of fPath into hash, used to catch up on data that is already on disk
+	with open(fPath, 'rb') as f:
+		f.seek(start)
+		while start < end:
+			buf = f.read(min(chunkSize, end - start))
+			if not buf:
+				raise IOError('%s is shorter than expected (%d/%d)' % (fPath, start, end))
+			hash.update(buf)
+			start += len(buf)
+
 def read_at(f, off, len):
 	f.seek(off)
 	return f.read(len)
@@ -155,7 +179,7 @@ def make_request(method, url, certificate='', hdArgs={}):
 	}
 	reqHd.update(hdArgs)
 
-	r = requests.request(method, url, cert=certificate, headers=reqHd, verify=False, stream=True)
+	r = cdn.request(method, url, cert=certificate, headers=reqHd)
 
 	if r.status_code == 403:
 		raise IOError('Request rejected by server! Check your cert')
@@ -232,15 +256,317 @@ def get_name(titleId):
 	return 'Unknown Title'
 
 
-def download_file(url, fPath, titleId = None):
+def load_segment_map(mapPath):
+	try:
+		with open(mapPath, encoding='utf-8') as f:
+			j = json.load(f)
+		return j['size'], j['segments']
+	except BaseException as e:
+		Print.error('could not read resume map %s: %s' % (mapPath, str(e)))
+		return None, None
+
+
+def save_segment_map(mapPath, size, segments):
+	# segments are [start, end, done], end exclusive, done counts the bytes written from start
+	tmpPath = mapPath + '.tmp'
+	with open(tmpPath, 'w', encoding='utf-8') as f:
+		json.dump({'size': size, 'segments': segments}, f)
+	os.replace(tmpPath, mapPath)
+
+
+def plan_segments(url, size = None):
+	# splits a file of known size without asking the server, download_segments falls back to a single stream
+	# if it turns out to ignore Range. otherwise asks for the first byte to learn the size and whether it honours Range
+	if size is not None:
+		segments = split_segments(0, size)
+		return size, segments if len(segments) >= 2 else None
+
+	r = make_request('GET', url, hdArgs={'Range': 'bytes=0-0', 'Accept-Encoding': 'identity'})
+	contentRange = r.headers.get('Content-Range')
+	r.close()
+
+	if r.status_code != 206 or not contentRange or not '/' in contentRange:
+		return None, None
+
+	size = int(contentRange.split('/')[1])
+	segments = split_segments(0, size)
+
+	if len(segments) < 2:
+		return size, None
+
+	return size, segments
+
+
+def split_segments(start, size):
+	# cuts size bytes at file offset start into up to Config.download.segments [start, end, done] ranges
+	count = max(1, min(Config.download.segments, size // max(Config.download.minSegmentSize, 1)))
+	step = size // count
+	return [[start + i * step, start + ((i + 1) * step if i < count - 1 else size), 0] for i in range(count)]
+
+
+def download_segment(url, fPath, segment, progress, base = 0):
+	# base is the file offset byte 0 of the url is written to
+	start, end, done = segment
+
+	if done >= end - start:
+		return
+
+	first = start + done - base
+	r = make_request('GET', url, hdArgs={'Range': 'bytes=%d-%d' % (first, end - 1 - base), 'Accept-Encoding': 'identity'})
+
+	try:
+		if r.status_code == 200 and first == 0:
+			# the whole file, it is cut at the end of the segment below
+			pass
+		elif r.status_code == 200:
+			raise RangeIgnored('server ignored range %d-%d' % (first, end - 1 - base))
+		elif r.status_code != 206 or not (r.headers.get('Content-Range') or '').startswith('bytes %d-' % first):
+			raise IOError('server did not honour range %d-%d, status %d' % (first, end - 1 - base, r.status_code))
+
+		with open(fPath, 'r+b') as f:
+			f.seek(start + done)
+
+			for chunk in r.iter_content(0x100000):
+				chunk = chunk[:end - start - segment[2]]
+				f.write(chunk)
+				# the resume map may only claim bytes that actually reached the file
+				f.flush()
+				progress(segment, chunk)
+
+				if segment[2] >= end - start or not Config.isRunning:
+					break
+	finally:
+		r.close()
+
+
+def download_segments(url, fPath, segments, base = 0, status = None, hash = None, save = None, lock = None):
+	# downloads the url to offset base of the existing file fPath, its segments in parallel.
+	# save() is called under lock about every second to persist the segments for resuming.
+	# hash is fed in offset order by a thread of its own while the segments download: chunks that arrive ahead of
+	# the hashed edge are held in memory until it reaches them, up to pendingMax bytes. Past that, and for data
+	# already on disk when resuming, the bytes are read back from the file as soon as the edge gets to them.
+	# a server ignoring Range gets one plain request instead, see sequential()
+	lock = lock or threading.Lock()
+	changed = threading.Condition(lock)
+	end = segments[-1][1]
+	hashed = [base]
+	pending = {}
+	pendingSize = [0]
+	pendingMax = 0x4000000
+	finished = [False]
+	saved = [time.time()]
+
+	def progress(segment, chunk):
+		n = len(chunk)
+
+		if not n:
+			return
+
+		with lock:
+			offset = segment[0] + segment[2]
+			segment[2] += n
+
+			if hash and (offset == hashed[0] or pendingSize[0] + n <= pendingMax):
+				pending[offset] = chunk
+				pendingSize[0] += n
+				changed.notify_all()
+
+			if status:
+				status.add(n)
+
+			if save and time.time() - saved[0] > 1:
+				save()
+				saved[0] = time.time()
+
+	def written(offset):
+		# end of the data on disk that follows offset without a gap
+		for segment in segments:
+			if segment[0] <= offset < segment[1]:
+				return segment[0] + segment[2]
+		return offset
+
+	def hashRun():
+		while True:
+			with lock:
+				while True:
+					if hashed[0] >= end:
+						return
+
+					chunk = pending.pop(hashed[0], None)
+					if chunk is not None:
+						pendingSize[0] -= len(chunk)
+						break
+
+					stop = min([written(hashed[0])] + [offset for offset in pending if offset > hashed[0]])
+					if stop > hashed[0]:
+						break
+
+					if finished[0]:
+						return
+
+					changed.wait()
+
+			if chunk is not None:
+				hash.update(chunk)
+				hashed[0] += len(chunk)
+			else:
+				sha256_update(hash, fPath, hashed[0], stop)
+				hashed[0] = stop
+
+	def run(segment):
+		# a connection dropped mid segment picks up where it stopped
+		for attempt in range(Config.cdn.retries + 1):
+			try:
+				return download_segment(url, fPath, segment, progress, base)
+			except RangeIgnored:
+				raise
+			except (IOError, requests.exceptions.RequestException) as e:
+				if attempt == Config.cdn.retries or not Config.isRunning:
+					raise
+				Print.error('segment %d-%d failed, retrying: %s' % (segment[0], segment[1], str(e)))
+
+	def sequential():
+		# the whole url in one request, written from base on. bytes the segments already hold are skipped,
+		# so the resume map and the in order hash stay valid
+		r = make_request('GET', url, hdArgs={'Accept-Encoding': 'identity'})
+
+		try:
+			if r.status_code != 200:
+				raise IOError('unexpected status %d for %s' % (r.status_code, url))
+
+			offset = base
+			i = 0
+
+			with open(fPath, 'r+b') as f:
+				for chunk in r.iter_content(0x100000):
+					while chunk and i < len(segments):
+						segment = segments[i]
+						n = min(len(chunk), segment[1] - offset)
+						piece, chunk = chunk[:n], chunk[n:]
+						skip = max(0, segment[0] + segment[2] - offset)
+
+						if skip < n:
+							f.seek(offset + skip)
+							f.write(piece[skip:])
+							f.flush()
+							progress(segment, piece[skip:])
+
+						offset += n
+						if offset >= segment[1]:
+							i += 1
+
+					if offset >= end or not Config.isRunning:
+						break
+		finally:
+			r.close()
+
+	try:
+		with concurrent.futures.ThreadPoolExecutor(max_workers = len(segments) + 1) as pool:
+			hasher = pool.submit(hashRun) if hash else None
+
+			try:
+				ignored = None
+				for future in [pool.submit(run, segment) for segment in segments]:
+					try:
+						future.result()
+					except RangeIgnored as e:
+						ignored = e
+
+				if ignored and Config.isRunning:
+					Print.info('%s, downloading as a single stream' % str(ignored))
+					sequential()
+			finally:
+				with lock:
+					finished[0] = True
+					changed.notify_all()
+
+			if hasher:
+				hasher.result()
+	finally:
+		if save:
+			with lock:
+				save()
+
+	dlded = sum(segment[2] for segment in segments)
+
+	if dlded != end - base:
+		raise ValueError('Downloaded data is not as big as expected (%s/%s)!' % (dlded, end - base))
+
+
+def download_file_segmented(url, fPath, titleId = None, status = None, hash = None, size = None):
+	# fetches the file as several byte ranges in parallel, straight into their place in a preallocated file.
+	# returns None when the file can not be downloaded that way, the caller falls back to a single stream
+	expected = size
+	fName = os.path.basename(fPath).split()[0]
+	mapPath = fPath + '.segments'
+	size, segments = None, None
+
+	if os.path.isfile(mapPath) and os.path.isfile(fPath):
+		size, segments = load_segment_map(mapPath)
+
+		if segments is not None and (os.path.getsize(fPath) != size or (expected is not None and size != expected)):
+			segments = None
+
+	if segments is None:
+		if os.path.exists(fPath):
+			# left by a single stream download, which knows how to resume it
+			if os.path.isfile(mapPath):
+				os.remove(mapPath)
+			return None
+
+		size, segments = plan_segments(url, expected)
+
+		if segments is None:
+			return None
+
+		# the map goes first: a full size file without one would be taken for a finished single stream download
+		save_segment_map(mapPath, size, segments)
+
+		with open(fPath, 'wb') as f:
+			f.truncate(size)
+	else:
+		Print.info('Resuming download...')
+
+	s = status or Status.create(size, desc=fName, unit='B')
+	if titleId and not status:
+		s.id = titleId.upper()
+	s.add(sum(segment[2] for segment in segments))
+
+	try:
+		download_segments(url, fPath, segments, 0, s, hash, lambda: save_segment_map(mapPath, size, segments))
+	finally:
+		if not status:
+			s.close()
+
+	if os.path.getsize(fPath) != size:
+		raise ValueError('Downloaded data is not as big as expected (%s/%s)!' % (os.path.getsize(fPath), size))
+
+	os.remove(mapPath)
+	Print.debug('\r\nSaved to %s!' % fPath)
+	return fPath
+
+
+def download_file(url, fPath, titleId = None, status = None, hash = None, size = None):
+	# status: progress bar shared by the files of a title, a bar for this file is created when None
+	# hash: optional hashlib object, fed with the whole file as it is written
+	# size: the file size when known (from the cnmt), saves probing the server and skips splitting small files
 	fName = os.path.basename(fPath).split()[0]
 
+	if Config.download.segments > 1:
+		r = download_file_segmented(url, fPath, titleId, status, hash, size)
+		if r:
+			return r
+
 	if os.path.exists(fPath):
 		dlded = os.path.getsize(fPath)
 		r = make_request('GET', url, hdArgs={'Range': 'bytes=%s-' % dlded})
 
 		if r.headers.get('Server') != 'openresty/1.9.7.4':
 			Print.info('Download is already complete, skipping!')
+			if status:
+				status.add(dlded)
+			if hash:
+				sha256_update(hash, fPath, 0, dlded)
 			return fPath
 		elif r.headers.get('Content-Range') == None:  # CDN doesn't return a range if request >= filesize
 			fSize = int(r.headers.get('Content-Length'))
@@ -249,9 +575,15 @@ def download_file(url, fPath, titleId = None):
 
 		if dlded == fSize:
 			Print.info('Download is already complete, skipping!')
+			if status:
+				status.add(dlded)
+			if hash:
+				sha256_update(hash, fPath, 0, dlded)
 			return fPath
 		elif dlded < fSize:
 			Print.info('Resuming download...')
+			if hash:
+				sha256_update(hash, fPath, 0, dlded)
 			f = open(fPath, 'ab')
 		else:
 			Print.error('Existing file is bigger than expected (%s/%s), restarting download...' % (dlded, fSize))
@@ -265,20 +597,27 @@ def download_file(url, fPath, titleId = None):
 
 	chunkSize = 0x100000
 
-	if fSize >= 10000:
-		s = Status.create(fSize, desc=fName, unit='B')
-		s.id = titleId.upper()
+	if fSize >= 10000 or status:
+		s = status
+		if not s:
+			s = Status.create(fSize, desc=fName, unit='B')
+			s.id = titleId.upper()
 		s.add(dlded)
 		for chunk in r.iter_content(chunkSize):
 			f.write(chunk)
+			if hash:
+				hash.update(chunk)
 			s.add(len(chunk))
 			dlded += len(chunk)
 
 			if not Config.isRunning:
 				break
-		s.close()
+		if not status:
+			s.close()
 	else:
 		f.write(r.content)
+		if hash:
+			hash.update(r.content)
 		dlded += len(r.content)
 
 	if fSize != 0 and dlded != fSize:
@@ -317,6 +656,25 @@ def decrypt_NCA(fPath, outDir=''):
 	return outDir
 
 
+def read_cnmt(ncaPath):
+	# decrypts the cnmt nca in process and parses the .cnmt file of its pfs0 section, nothing is written to disk
+	nca = Fs.Nca()
+	nca.open(ncaPath)
+
+	try:
+		for fs in nca.sectionFilesystems:
+			if fs.fsType != Fs.Type.Fs.PFS0:
+				continue
+
+			for f in fs.find('.cnmt'):
+				f.rewind()
+				return cnmt(f.read(), nca.header.cryptoType2)
+	finally:
+		nca.close()
+
+	raise IOError('no cnmt in ' + ncaPath)
+
+
 def verify_NCA(ncaFile, titleKey):
 	if not titleKey:
 		return False
@@ -336,6 +694,69 @@ def verify_NCA(ncaFile, titleKey):
 	return True
 
 
+def verify_NSP(nspPath, titleKey):
+	# verify_NCA for an nsp assembled in place: hactool needs a loose nca, so the title key is instead checked
+	# against the first encrypted pfs0 section of the biggest nca, by decrypting its header in process
+	if not titleKey:
+		return False
+
+	try:
+		with open(nspPath, 'rb') as f:
+			offset, size = max(nsp_entries(f).values(), key=lambda entry: entry[1])
+
+			f.seek(offset)
+			header = NcaHeader()
+			header.open(MemoryFile(f.read(0xC00), Fs.Type.Crypto.XTS, uhx(Keys.get('header_key'))))
+
+			if not header.hasTitleRights():
+				return True
+
+			key = Keys.decryptTitleKey(uhx(titleKey), header.masterKey)
+
+			for i in range(4):
+				header.seek(0x400 + i * 0x200)
+				fs = Fs.Pfs0(header.read(0x200))
+
+				if fs.fsType != Fs.Type.Fs.PFS0 or fs.cryptoType != Fs.Type.Crypto.CTR:
+					continue
+
+				sectionOffset = header.sectionTables[i].offset + fs.sectionStart
+				f.seek(offset + sectionOffset)
+
+				if MemoryFile(f.read(0x10), Fs.Type.Crypto.CTR, key, fs.cryptoCounter, offset = sectionOffset).read()[0:4] != b'PFS0':
+					Print.error("\nNCA Verification failed. Probably a bad titlekey.")
+					return False
+				break
+	except BaseException as e:
+		Print.error("Status : FAIL, " + str(e))
+		return False
+
+	Print.debug("\nTitlekey verification successful.")
+	return True
+
+
+def nsp_entries(f):
+	# {name: (offset, size)} of the files in the pfs0 header at the start of f
+	f.seek(0)
+	magic, filesNb, stringTableSize = upk('<4sII', f.read(0xC))
+
+	if magic != b'PFS0':
+		raise IOError('not a pfs0 file')
+
+	f.seek(0x10)
+	table = f.read(filesNb * 0x18)
+	stringTable = f.read(stringTableSize)
+	dataOffset = 0x10 + filesNb * 0x18 + stringTableSize
+
+	entries = {}
+	for n in range(filesNb):
+		offset, size, nameOffset = upk('<QQI', table[n * 0x18:n * 0x18 + 0x14])
+		name = stringTable[nameOffset:].split(b'\x00')[0].decode()
+		entries[name] = (dataOffset + offset, size)
+
+	return entries
+
+
 def get_biggest_file(path):
 	try:
 		objects = os.listdir(path)
@@ -362,7 +783,35 @@ def download_cetk(rightsID, fPath):
 	return cetk
 
 
-def download_title(gameDir, titleId, ver, tkey=None, nspRepack=False, n='', verify=False, retry=0):
+# NCAs fetched at once across every download thread, each title gets an equal share as its own pool size
+global ncaSlots
+ncaSlots = None
+ncaSlotsLock = threading.Lock()
+
+def download_slots():
+	global ncaSlots
+
+	with ncaSlotsLock:
+		if ncaSlots is None:
+			ncaSlots = threading.BoundedSemaphore(max(Config.download.ncaThreads, 1))
+		return ncaSlots
+
+
+def download_plan(entries):
+	# largest first, alternating with the smallest, so the long downloads start early and the small ones fill the gaps
+	entries = sorted(entries, key=lambda entry: entry[2], reverse=True)
+	plan = []
+
+	while entries:
+		plan.append(entries.pop(0))
+		if entries:
+			plan.append(entries.pop())
+
+	return plan
+
+
+def download_title(gameDir, titleId, ver, tkey=None, nspRepack=False, n='', verify=True, retry=0, nspPath=None):
+	# nspPath: with nspRepack, the ncas are downloaded straight into this nsp instead of gameDir
 	try:
 		Print.info('Downloading %s [%s] v%s:' % (get_name(titleId), titleId, ver))
 		titleId = titleId.lower()
@@ -391,9 +840,7 @@ def download_title(gameDir, titleId, ver, tkey=None, nspRepack=False, n='', veri
 		url = 'https://atum%s.hac.%s.d4c.nintendo.net/c/a/%s?device_id=%s' % (n, env, CNMTid, deviceId)
 		fPath = os.path.join(gameDir, CNMTid + '.cnmt.nca')
 		cnmtNCA = download_file(url, fPath, titleId)
-		cnmtDir = decrypt_NCA(cnmtNCA)
-		CNMT = cnmt(os.path.join(cnmtDir, 'section0', os.listdir(os.path.join(cnmtDir, 'section0'))[0]),
-					os.path.join(cnmtDir, 'Header.bin'))
+		CNMT = read_cnmt(cnmtNCA)
 
 		if nspRepack == True:
 			outf = os.path.join(gameDir, '%s.xml' % os.path.basename(cnmtNCA.strip('.nca')))
@@ -454,17 +901,75 @@ def download_title(gameDir, titleId, ver, tkey=None, nspRepack=False, n='', veri
 			5: [],
 			6: [],
 		}
-		for type in [0, 3, 4, 5, 1, 2, 6]:  # Download smaller files first
-			for ncaID in CNMT.parse(CNMT.ncaTypes[type]):
-				Print.debug('Downloading %s entry (%s.nca)...' % (CNMT.ncaTypes[type], ncaID))
-				url = 'https://atum%s.hac.%s.d4c.nintendo.net/c/c/%s?device_id=%s' % (n, env, ncaID, deviceId)
-				fPath = os.path.join(gameDir, ncaID + '.nca')
-				NCAs[type].append(download_file(url, fPath, titleId))
-				if verify:
-					if calc_sha256(fPath) != CNMT.parse(CNMT.ncaTypes[type])[ncaID][2]:
-						Print.error('%s is corrupted, hashes don\'t match!' % os.path.basename(fPath))
+		# the content table is read once, every NCA is checked against its hash as it downloads
+		contents = CNMT.parse()
+		entries = []
+		for type in [0, 3, 4, 5, 1, 2, 6]:
+			for ncaID, (ncaType, size, hash) in contents.items():
+				if ncaType == CNMT.ncaTypes[type]:
+					entries.append((type, ncaID, int(size), hash))
+
+		NSP = None
+		if nspRepack == True and nspPath:
+			# the nsp layout is known up front: preallocate it and write the small local files, the ncas go to their offsets
+			files = [certPath, tikPath]
+			for key in [1, 5, 2, 4, 6]:
+				files.extend(os.path.join(gameDir, entry[1] + '.nca') for entry in entries if entry[0] == key)
+			files.append(cnmtNCA)
+			files.append(cnmtXML)
+			files.extend(os.path.join(gameDir, entry[1] + '.nca') for entry in entries if entry[0] == 3)
+
+			sizes = {entry[1] + '.nca': entry[2] for entry in entries}
+			NSP = nsp(nspPath, files)
+			NSP.allocate([sizes.get(os.path.basename(file)) or os.path.getsize(file) for file in files], sizes.keys())
+
+		def fetch(entry):
+			type, ncaID, size, hash = entry
+			Print.debug('Downloading %s entry (%s.nca)...' % (CNMT.ncaTypes[type], ncaID))
+			url = 'https://atum%s.hac.%s.d4c.nintendo.net/c/c/%s?device_id=%s' % (n, env, ncaID, deviceId)
+			fPath = os.path.join(gameDir, ncaID + '.nca')
+			digest = sha256() if verify else None
+
+			with download_slots():
+				if NSP:
+					NSP.download(url, ncaID + '.nca', status, digest)
+				else:
+					download_file(url, fPath, titleId, status, digest, size)
+
+			if digest:
+				if digest.hexdigest() != hash:
+					# removed so the retry fetches it again instead of skipping a complete looking file
+					if NSP:
+						NSP.reset(ncaID + '.nca')
 					else:
-						Print.info('Verified %s...' % os.path.basename(fPath))
+						os.remove(fPath)
+					raise IOError('%s is corrupted, hashes don\'t match!' % os.path.basename(fPath))
+				else:
+					Print.info('Verified %s...' % os.path.basename(fPath))
+
+			return fPath
+
+		# the NCAs of the title are fetched on a small pool, progress goes to one bar for the whole title
+		status = Status.create(sum(entry[2] for entry in entries) or 1, desc=get_name(titleId)[:30], unit='B')
+		status.id = titleId.upper()
+		paths = {}
+
+		try:
+			with concurrent.futures.ThreadPoolExecutor(max_workers = max(1, Config.download.ncaThreads // max(Config.threads, 1))) as pool:
+				futures = {pool.submit(fetch, entry): entry for entry in download_plan(entries)}
+
+				try:
+					for future in concurrent.futures.as_completed(futures):
+						paths[futures[future][1]] = future.result()
+				except BaseException:
+					for future in futures:
+						future.cancel()
+					raise
+		finally:
+			status.close()
+
+		for type, ncaID, size, hash in entries:
+			NCAs[type].append(paths[ncaID])
 
 		if nspRepack == True:
 			files = []
@@ -483,12 +988,12 @@ def download_title(gameDir, titleId, ver, tkey=None, nspRepack=False, n='', veri
 
 		if retry < 5:
 			Print.error('An error occured while downloading, retry attempt %d: %s' % (retry, str(e)))
-			download_title(gameDir, titleId, ver, tkey, nspRepack, n, verify, retry)
+			return download_title(gameDir, titleId, ver, tkey, nspRepack, n, verify, retry, nspPath)
 		else:
 			raise
 
 
-def download_game(titleId, ver, tkey=None, nspRepack=False, name='', verify=False):
+def download_game(titleId, ver, tkey=None, nspRepack=False, name='', verify=True):
 	name = get_name(titleId)
 	gameType = ''
 
@@ -547,11 +1052,19 @@ def download_game(titleId, ver, tkey=None, nspRepack=False, name='', verify=Fals
 				return
 
 
-	files = download_title(gameDir, titleId, ver, tkey, nspRepack, verify=verify)
+	nspPath = None
+	if nspRepack == True and Config.download.streamNsp:
+		# assembled inside gameDir and only moved to outf once complete, so an unfinished nsp never looks downloaded
+		nspPath = os.path.join(gameDir, os.path.basename(outf))
+
+	files = download_title(gameDir, titleId, ver, tkey, nspRepack, verify=verify, nspPath=nspPath)
 
 	if gameType != 'UPD':
 		if tkey:
-			verified = verify_NCA(get_biggest_file(gameDir), tkey)
+			if nspPath:
+				verified = verify_NSP(nspPath, tkey)
+			else:
+				verified = verify_NCA(get_biggest_file(gameDir), tkey)
 
 			if not verified:
 				shutil.rmtree(gameDir)
@@ -561,9 +1074,12 @@ def download_game(titleId, ver, tkey=None, nspRepack=False, name='', verify=Fals
 	if nspRepack == True:
 		if files == None:
 			return
-		NSP = nsp(outf, files)
-		Print.debug('starting repack, This may take a while')
-		NSP.repack()
+		if nspPath:
+			nsp(nspPath, files).finish(outf)
+		else:
+			NSP = nsp(outf, files)
+			Print.debug('starting repack, This may take a while')
+			NSP.repack()
 		shutil.rmtree(gameDir)
 		Print.debug('cleaned up downloaded content')
 
@@ -579,7 +1095,8 @@ def download_game(titleId, ver, tkey=None, nspRepack=False, name='', verify=Fals
 
 
 class cnmt:
-	def __init__(self, fPath, hdPath):
+	def __init__(self, data, mkeyrev):
+		# data is the decrypted .cnmt file, mkeyrev the key generation of the nca it came from
 		self.packTypes = {0x1: 'SystemProgram',
 						  0x2: 'SystemData',
 						  0x3: 'SystemUpdate',
@@ -593,23 +1110,19 @@ class cnmt:
 		self.ncaTypes = {0: 'Meta', 1: 'Program', 2: 'Data', 3: 'Control',
 						 4: 'HtmlDocument', 5: 'LegalInformation', 6: 'DeltaFragment'}
 
-		f = open(fPath, 'rb')
+		f = BytesIO(data)
 
-		self.path = fPath
+		self.data = data
 		self.type = self.packTypes[read_u8(f, 0xC)]
 		self.id = '0%s' % format(read_u64(f, 0x0), 'x')
 		self.ver = str(read_u32(f, 0x8))
 		self.sysver = str(read_u64(f, 0x28))
 		self.dlsysver = str(read_u64(f, 0x18))
-		self.digest = hx(read_at(f, f.seek(0, 2) - 0x20, f.seek(0, 2))).decode()
-
-		with open(hdPath, 'rb') as ncaHd:
-			self.mkeyrev = str(read_u8(ncaHd, 0x220))
-
-		f.close()
+		self.digest = hx(data[-0x20:]).decode()
+		self.mkeyrev = str(mkeyrev)
 
 	def parse(self, ncaType=''):
-		f = open(self.path, 'rb')
+		f = BytesIO(self.data)
 
 		data = {}
 		if self.type == 'SystemUpdate':
@@ -689,6 +1202,66 @@ class nsp:
 	def __init__(self, outf, files):
 		self.path = outf
 		self.files = files
+		self.mapPath = outf + '.parts'
+		self.size = None
+		self.parts = None
+		self.lock = threading.Lock()
+
+	def allocate(self, fileSizes, remote):
+		# preallocates the nsp, writes its header and the files we have locally, and plans the byte ranges
+		# of the remote files (by name) which are tracked per file in the .parts map to resume them
+		hd = self.gen_header(fileSizes)
+		self.size = len(hd) + sum(fileSizes)
+		offsets = [len(hd) + sum(fileSizes[:n]) for n in range(len(self.files))]
+		remote = set(remote)
+
+		if os.path.isfile(self.mapPath) and os.path.isfile(self.path):
+			size, self.parts = load_segment_map(self.mapPath)
+
+			if self.parts is not None and (size != self.size or os.path.getsize(self.path) != self.size or set(self.parts) != remote):
+				self.parts = None
+
+			if self.parts is not None:
+				Print.info('Resuming %s...' % os.path.basename(self.path))
+
+		if self.parts is None:
+			self.parts = {}
+			for file, offset, size in zip(self.files, offsets, fileSizes):
+				if os.path.basename(file) in remote:
+					self.parts[os.path.basename(file)] = split_segments(offset, size)
+
+			with open(self.path, 'wb') as f:
+				f.truncate(self.size)
+
+		with open(self.path, 'r+b') as outf:
+			outf.write(hd)
+
+			for file, offset in zip(self.files, offsets):
+				if not os.path.basename(file) in remote:
+					outf.seek(offset)
+					with open(file, 'rb') as inf:
+						shutil.copyfileobj(inf, outf, 0x100000)
+
+		self.save()
+
+	def save(self):
+		save_segment_map(self.mapPath, self.size, self.parts)
+
+	def download(self, url, name, status, hash = None):
+		segments = self.parts[name]
+		status.add(sum(segment[2] for segment in segments))
+		download_segments(url, self.path, segments, segments[0][0], status, hash, self.save, self.lock)
+
+	def reset(self, name):
+		with self.lock:
+			for segment in self.parts[name]:
+				segment[2] = 0
+			self.save()
+
+	def finish(self, outf):
+		os.remove(self.mapPath)
+		os.replace(self.path, outf)
+		Print.debug('\t\tAssembled %s!' % outf)
 
 	def repack(self):
 		Print.debug('\tRepacking to NSP...')
@@ -722,14 +1295,15 @@ class nsp:
 		Print.debug('\t\tRepacked to %s!' % outf.name)
 		outf.close()
 
-	def gen_header(self):
+	def gen_header(self, fileSizes = None):
 		filesNb = len(self.files)
 		stringTable = '\x00'.join(os.path.basename(file) for file in self.files)
 		headerSize = 0x10 + (filesNb)*0x18 + len(stringTable)
 		remainder = 0x10 - headerSize%0x10
 		headerSize += remainder
 		
-		fileSizes = [os.path.getsize(file) for file in self.files]
+		if fileSizes is None:
+			fileSizes = [os.path.getsize(file) for file in self.files]
 		fileOffsets = [sum(fileSizes[:n]) for n in range(filesNb)]
 		
 		fileNamesLengths = [len(os.path.basename(file))+1 for file in self.files] # +1 for the \x00
@@ -1,7 +1,14 @@
 from Fs.File import File
+import Fs
 import Print
 from binascii import hexlify as hx, unhexlify as uhx
 
+class FsEntry:
+	def __init__(self, name, offset, size):
+		self.name = name
+		self.offset = offset
+		self.size = size
+
 class BaseFs(File):
 	def __init__(self, buffer, path = None, mode = None, cryptoType = -1, cryptoKey = -1, cryptoCounter = -1):		
 		self.buffer = buffer
@@ -15,7 +22,8 @@ class BaseFs(File):
 		#if buffer:
 		#	Hex.dump(buffer)
 			
-		self.files = []
+		self.entries = []
+		self._files = {}
 		
 		if buffer:
 			self.buffer = buffer
@@ -41,13 +49,44 @@ class BaseFs(File):
 		
 	def __getitem__(self, key):
 		if isinstance(key, str):
-			for f in self.files:
-				if f.name == key:
-					return f
+			for i, entry in enumerate(self.entries):
+				if entry.name == key:
+					return self.getFile(i)
 		elif isinstance(key, int):
-			return self.files[key]
+			return self.getFile(key)
 				
 		raise IOError('FS File Not Found')
+
+	def __iter__(self):
+		for i in range(len(self.entries)):
+			yield self.getFile(i)
+
+	@property
+	def files(self):
+		return list(self)
+
+	def getFile(self, i):
+		# child files are only built (and their headers parsed) the first time they are accessed
+		if i not in self._files:
+			entry = self.entries[i]
+			f = self.createFile(entry.name)
+			f._path = entry.name
+			self._files[i] = self.partition(entry.offset, entry.size, f)
+		return self._files[i]
+
+	def createFile(self, name):
+		return Fs.factory(name)
+
+	def find(self, suffix):
+		for i, entry in enumerate(self.entries):
+			if entry.name.endswith(suffix):
+				yield self.getFile(i)
+
+	def setEntries(self, entries):
+		for i in self._files.values():
+			i.close()
+		self.entries = entries
+		self._files = {}
 		
 	def printInfo(self, maxDepth = 3, indent = 0):
 		tabs = '\t' * indent
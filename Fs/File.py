@@ -1,7 +1,11 @@
 from enum import IntEnum
 import Fs.Type
 import aes128
+import Config
+import PageCache
 import Print
+import os
+import mmap
 import Hex
 from binascii import hexlify as hx, unhexlify as uhx
 
@@ -17,6 +21,8 @@ class BaseFile:
 		self.isPartition = False
 		self._children = []
 		self._path = None
+		self._fileId = None
+		self._map = None
 		self._buffer = None
 		self._relativePos = 0x0
 		self._bufferOffset = 0x0
@@ -65,6 +71,18 @@ class BaseFile:
 		
 		return n
 
+	def rootOffset(self, offset = 0):
+		# (os level file, absolute offset) of offset in this file, None if a layer between us and the file is encrypted
+		f = self
+
+		while isinstance(f, BaseFile):
+			if f.crypto:
+				return None
+			offset += f.offset
+			f = f.f
+
+		return f, offset
+
 	def removeChild(self, child):
 		a = []
 
@@ -79,24 +97,30 @@ class BaseFile:
 			size = self.size
 
 		return self.f.read(size)
+
+	def readinto(self, buffer):
+		return self.f.readinto(buffer)
+
+	def view(self, size):
+		return self.read(size)
 		
 	def readInt8(self, byteorder='little', signed = False):
-		return self.read(1)[0]
+		return self.view(1)[0]
 		
 	def readInt16(self, byteorder='little', signed = False):
-		return int.from_bytes(self.read(2), byteorder=byteorder, signed=signed)
+		return int.from_bytes(self.view(2), byteorder=byteorder, signed=signed)
 		
 	def readInt32(self, byteorder='little', signed = False):
-		return int.from_bytes(self.read(4), byteorder=byteorder, signed=signed)
+		return int.from_bytes(self.view(4), byteorder=byteorder, signed=signed)
 		
 	def readInt64(self, byteorder='little', signed = False):
-		return int.from_bytes(self.read(8), byteorder=byteorder, signed=signed)
+		return int.from_bytes(self.view(8), byteorder=byteorder, signed=signed)
 
 	def readInt128(self, byteorder='little', signed = False):
-		return int.from_bytes(self.read(16), byteorder=byteorder, signed=signed)
+		return int.from_bytes(self.view(16), byteorder=byteorder, signed=signed)
 
 	def readInt(self, size, byteorder='little', signed = False):
-		return int.from_bytes(self.read(size), byteorder=byteorder, signed=signed)
+		return int.from_bytes(self.view(size), byteorder=byteorder, signed=signed)
 		
 	def write(self, value, size = None):
 		if size != None:
@@ -203,6 +227,16 @@ class BaseFile:
 			if isinstance(path, str):
 				self.f = open(path, mode)
 				self._path = path
+
+				st = os.fstat(self.f.fileno())
+				self._fileId = (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+				if mode == 'rb' and Config.fs.mmap and st.st_size > 0:
+					try:
+						self._map = mmap.mmap(self.f.fileno(), 0, access = mmap.ACCESS_READ)
+					except BaseException as e:
+						Print.error('mmap failed for ' + path + ': ' + str(e))
+						self._map = None
 				
 				self.f.seek(0,2)
 				self.size = self.f.tell()
@@ -224,6 +258,13 @@ class BaseFile:
 			self._children = []
 
 			if not isinstance(self.f, BaseFile):
+				if self._map is not None:
+					try:
+						self._map.close()
+					except BufferError:
+						# pages handed out as views still reference it, the mapping goes away with them
+						pass
+					self._map = None
 				self.f.close()
 			else:
 				self.f.removeChild(self)
@@ -258,6 +299,10 @@ class BufferedFile(BaseFile):
 		super(BufferedFile, self).__init__(path, mode, cryptoType, cryptoKey, cryptoCounter)
 
 	def read(self, size = None, direct = False):
+		return bytes(self.view(size))
+
+	def view(self, size = None):
+		# returns a memoryview into the page buffer, only valid until the next read or write
 		if not size:
 			size = self.size
 
@@ -265,8 +310,39 @@ class BufferedFile(BaseFile):
 			size = self.size - self._relativePos
 
 		if size < 1:
-			return b''
+			return memoryview(b'')
+
+		offset = self.fillBuffer(size)
+		self._relativePos += size
+		return memoryview(self._buffer)[offset:offset+size]
+
+	def readinto(self, buffer):
+		buffer = memoryview(buffer).cast('B')
+		size = min(len(buffer), self.size - self._relativePos)
 
+		if size < 1:
+			return 0
+
+		if not self.crypto and size >= self._bufferSize:
+			# large unencrypted reads bypass the page buffer and land directly in the caller's buffer
+			self.flushBuffer()
+			data = self.mappedView(self._relativePos, size)
+
+			if data is not None:
+				buffer[:len(data)] = data
+				size = len(data)
+			else:
+				super(BufferedFile, self).seek(self._relativePos)
+				size = super(BufferedFile, self).readinto(buffer[:size])
+		else:
+			offset = self.fillBuffer(size)
+			buffer[:size] = memoryview(self._buffer)[offset:offset+size]
+
+		self._relativePos += size
+		return size
+
+	def fillBuffer(self, size):
+		# makes sure the page buffer covers size bytes at the current position, returns the position's offset in the page
 		if self._bufferOffset == None or self._buffer == None or self._relativePos < self._bufferOffset or (self._relativePos + size)  > self._bufferOffset + len(self._buffer):
 			self.flushBuffer()
 			#self._bufferOffset = self._relativePos & ~(self._bufferAlign-1)
@@ -280,17 +356,36 @@ class BufferedFile(BaseFile):
 			if pageReadSize > self.size - self._bufferOffset:
 				pageReadSize = self.size - self._bufferOffset
 
+			page = self.mappedView(self._bufferOffset, pageReadSize)
+
+			if page is not None and not self.crypto:
+				# unencrypted pages are served straight out of the mapping
+				self._buffer = page
+				return self._relativePos - self._bufferOffset
+
+			key = self.pageKey()
+			cached = PageCache.get(key, self._relativePos + size - self._bufferOffset)
+
+			if cached is not None:
+				self._buffer = cached
+				return self._relativePos - self._bufferOffset
+
 			#Print.info('disk read %s\t\t: relativePos = %x, bufferOffset = %x, align = %x, size = %x, pageReadSize = %x, bufferSize = %x' % (self.__class__.__name__, self._relativePos, self._bufferOffset, self._bufferAlign, size, pageReadSize, self._bufferSize))
-			super(BufferedFile, self).seek(self._bufferOffset)
-			self._buffer = super(BufferedFile, self).read(pageReadSize)
-			self.pageRefreshed()
-			if len(self._buffer) == 0:
+			if page is not None:
+				self._buffer = bytes(page)
+			else:
+				super(BufferedFile, self).seek(self._bufferOffset)
+				self._buffer = bytearray(pageReadSize)
+				n = super(BufferedFile, self).readinto(self._buffer)
+				del self._buffer[n:]
+
+			if not self._buffer:
+				self._buffer = None
 				raise IOError('read returned empty ' + hex(self.offset))
-				
-		offset = self._relativePos - self._bufferOffset
-		r = self._buffer[offset:offset+size]
-		self._relativePos += size
-		return r
+			self.pageRefreshed()
+			PageCache.put(key, self._buffer)
+
+		return self._relativePos - self._bufferOffset
 
 	def write(self, value, size = None):
 		#if not size:
@@ -304,9 +399,12 @@ class BufferedFile(BaseFile):
 			pos = self.tell()
 			self.read(size)
 			self.seek(pos)
+
+		if not isinstance(self._buffer, bytearray):
+			self._buffer = bytearray(self._buffer)
 				
 		offset = self._relativePos - self._bufferOffset
-		self._buffer = self._buffer[:offset] + (value) + self._buffer[offset+size:]
+		self._buffer[offset:offset+size] = value
 		self._relativePos += size
 		self._bufferDirty = True
 		
@@ -320,6 +418,45 @@ class BufferedFile(BaseFile):
 			super(BufferedFile, self).write(self.getPageFlushBuffer(self._buffer))
 			self._bufferDirty = False
 
+			key = self.pageKey()
+			if key:
+				PageCache.invalidate(key[0])
+
+	def mappedView(self, offset, size):
+		# positional read from the root file's mapping, None unless it is mapped and nothing between us and it is encrypted
+		f = self
+
+		while isinstance(f, BaseFile):
+			if f is not self and f.crypto:
+				return None
+
+			if f._map is not None:
+				return memoryview(f._map)[offset:offset+size]
+
+			offset += f.offset
+			f = f.f
+
+		return None
+
+	def pageKey(self):
+		# identifies the current page across every partition opened on the same file: (file id, absolute offset, crypto chain)
+		offset = 0
+		layers = []
+		f = self
+
+		while isinstance(f, BaseFile):
+			offset += f.offset
+			if f.crypto:
+				layers.append((f, offset))
+			root = f
+			f = f.f
+
+		if root._fileId is None:
+			return None
+
+		chain = tuple((offset - end + l.offset, l.cryptoType, bytes(l.cryptoKey), bytes(l.cryptoCounter) if l.cryptoCounter else None) for l, end in layers)
+		return (root._fileId, offset + self._bufferOffset, chain)
+
 	def getPageFlushBuffer(self, buffer):
 		if self.crypto:
 			if self.cryptoType == Fs.Type.Crypto.CTR:
@@ -411,6 +548,15 @@ class MemoryFile(File):
 
 		return self.buffer[self._relativePos:self._relativePos+size]
 
+	def readinto(self, buffer):
+		buffer = memoryview(buffer).cast('B')
+		data = memoryview(self.buffer)[self._relativePos:self._relativePos+len(buffer)]
+		buffer[:len(data)] = data
+		return len(data)
+
+	def view(self, size):
+		return memoryview(self.buffer)[self._relativePos:self._relativePos+size]
+
 	def write(self, value, size = None):
 		return
 
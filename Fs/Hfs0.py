@@ -8,7 +8,7 @@ from Fs.File import File
 from hashlib import sha256
 import Fs.Type
 from Fs.Pfs0 import Pfs0
-from Fs.BaseFs import BaseFs
+from Fs.BaseFs import BaseFs, FsEntry
 import os
 import re
 import pathlib
@@ -44,7 +44,7 @@ class Hfs0(Pfs0):
 		stringEndOffset = stringTableSize
 		
 		headerSize = 0x10 + 0x40 * fileCount + stringTableSize
-		self.files = []
+		entries = []
 
 		for i in range(fileCount):
 			i = fileCount - i - 1
@@ -58,19 +58,17 @@ class Hfs0(Pfs0):
 
 			self.readInt32() # junk data
 
-			#if name in ['update', 'secure', 'normal']:
-			if name == 'secure':
-				f = Hfs0(None)
-				#f = factory(name)
-			else:
-				f = Fs.factory(name)
+			entries.append(FsEntry(name, offset + headerSize, size))
 
-			f._path = name
-			f.offset = offset
-			f.size = size
-			self.files.append(self.partition(offset + headerSize, f.size, f))
+		entries.reverse()
+		self.setEntries(entries)
 
-		self.files.reverse()
+	def createFile(self, name):
+		#if name in ['update', 'secure', 'normal']:
+		if name == 'secure':
+			return Hfs0(None)
+			#return factory(name)
+		return Fs.factory(name)
 
 	def printInfo(self, maxDepth = 3, indent = 0):
 		tabs = '\t' * indent
@@ -77,9 +77,6 @@ class Nsp(Pfs0):
 	def __lt__(self, other):
 		return str(self.path) < str(other.path)
 				
-	def __iter__(self):
-		return self.files.__iter__()
-		
 	def title(self):
 		if not self.titleId:
 			raise IOError('NSP no titleId set')
@@ -98,11 +95,7 @@ class Nsp(Pfs0):
 		if title.isUpdate or title.isDLC or not title.updateId:
 			return None
 
-		for i, nsp in Nsps.files.items():
-			if nsp.titleId == title.updateId:
-				return nsp
-
-		return None
+		return Nsps.getByTitleId(title.updateId)
 
 	def isUpdateAvailable(self):
 		title = self.title()
@@ -134,6 +127,7 @@ class Nsp(Pfs0):
 			t = self.ticket()
 			rightsId = hx(t.getRightsId().to_bytes(0x10, byteorder='big')).decode('utf-8').upper()
 			self.titleId = rightsId[0:16]
+			Nsps.reindexFile(self)
 			self.title().setRightsId(rightsId)
 			Print.debug('rightsId = ' + rightsId)
 			Print.debug(self.titleId + ' key = ' +  str(t.getTitleKeyBlock()))
@@ -153,13 +147,15 @@ class Nsp(Pfs0):
 			i = 0
 
 			pageSize = 0x10000
+			buf = bytearray(pageSize)
+			view = memoryview(buf)
 
 			while True:
-				buf = nspF.read(pageSize)
-				if len(buf) == 0:
+				n = nspF.readinto(buf)
+				if n == 0:
 					break
-				i += len(buf)
-				f.write(buf)
+				i += n
+				f.write(view[:n])
 			f.close()
 			Print.info(filePath)
 
@@ -181,6 +177,7 @@ class Nsp(Pfs0):
 	def setId(self, id):
 		if re.match('[A-F0-9]{16}', id, re.I):
 			self.titleId = id
+			Nsps.reindexFile(self)
 
 	def getId(self):
 			return self.titleId or ('0' * 16)
@@ -212,6 +209,8 @@ class Nsp(Pfs0):
 			Print.info('could not get title id from filename, name needs to contain [titleId] : ' + path)
 			self.titleId = None
 
+		Nsps.reindexFile(self)
+
 		z = re.match('.*\[v([0-9]+)\].*', path, re.I)
 		if z:
 			self.version = z.groups()[0]
@@ -267,7 +266,10 @@ class Nsp(Pfs0):
 		return s.strip()
 
 	def dict(self):
-		return {"titleId": self.titleId, "hasValidTicket": self.hasValidTicket, 'version': self.version, 'timestamp': self.timestamp, 'path': self.path }
+		return {"titleId": self.titleId, "hasValidTicket": self.hasValidTicket, 'version': self.version, 'timestamp': self.timestamp, 'path': self.path, 'fileSize': self.fileSize, 'fileModified': self.fileModified }
+
+	def fingerprint(self):
+		return (self.fileSize, self.fileModified)
 		
 	def fileName(self):
 		bt = None
@@ -323,17 +325,17 @@ class Nsp(Pfs0):
 		return format
 		
 	def ticket(self):
-		for f in (f for f in self if type(f) == Ticket):
+		for f in (f for f in self.find('.tik') if type(f) == Ticket):
 			return f
 		raise IOError('no ticket in NSP')
 		
 	def cnmt(self):
-		for f in (f for f in self if f._path.endswith('.cnmt.nca')):
+		for f in self.find('.cnmt.nca'):
 			return f
 		raise IOError('no cnmt in NSP')
 
 	def xml(self):
-		for f in (f for f in self if f._path.endswith('.xml')):
+		for f in self.find('.xml'):
 			return f
 		raise IOError('no XML in NSP')
 
@@ -15,7 +15,7 @@ import Config
 import Print
 import Nsps
 from tqdm import tqdm
-from Fs.BaseFs import BaseFs
+from Fs.BaseFs import BaseFs, FsEntry
 
 MEDIA_SIZE = 0x200
 		
@@ -77,7 +77,7 @@ class Pfs0(BaseFs):
 		stringEndOffset = stringTableSize
 		
 		headerSize = 0x10 + 0x18 * fileCount + stringTableSize
-		self.files = []
+		entries = []
 
 		for i in range(fileCount):
 			i = fileCount - i - 1
@@ -91,15 +91,10 @@ class Pfs0(BaseFs):
 
 			self.readInt32() # junk data
 
-			f = Fs.factory(name)
+			entries.append(FsEntry(name, offset + headerSize, size))
 
-			f._path = name
-			f.offset = offset
-			f.size = size
-			
-			self.files.append(self.partition(offset + headerSize, f.size, f))
-
-		self.files.reverse()
+		entries.reverse()
+		self.setEntries(entries)
 
 		'''
 		self.seek(0x10 + fileCount * 0x18)
@@ -128,13 +128,15 @@ class Xci(File):
 			i = 0
 
 			pageSize = 0x10000
+			buf = bytearray(pageSize)
+			view = memoryview(buf)
 
 			while True:
-				buf = nspF.read(pageSize)
-				if len(buf) == 0:
+				n = nspF.readinto(buf)
+				if n == 0:
 					break
-				i += len(buf)
-				f.write(buf)
+				i += n
+				f.write(view[:n])
 			f.close()
 			Print.info(filePath)
 		
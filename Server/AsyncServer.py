@@ -0,0 +1,155 @@
+import asyncio
+import concurrent.futures
+import http.client
+import http.server
+import io
+import time
+import Config
+import Print
+import Server
+
+# asyncio engine: connections are handled on one event loop, request handlers keep the
+# synchronous Server.route / NutRequest / NutResponse contract and run on a worker pool.
+# A slow client only ever blocks the worker serving it, never the loop or other connections.
+
+global loop
+global pool
+loop = None
+pool = None
+
+class Writer:
+	# wfile replacement used from worker threads, waits for the transport to drain so large bodies are flow controlled
+	def __init__(self, writer):
+		self.writer = writer
+
+	async def send(self, data):
+		self.writer.write(data)
+		await self.writer.drain()
+
+	def write(self, data):
+		# the caller may reuse its buffer as soon as we return
+		data = bytes(data)
+		asyncio.run_coroutine_threadsafe(self.send(data), loop).result()
+		return len(data)
+
+	def flush(self):
+		pass
+
+	async def sendfile(self, f, offset, size):
+		await self.writer.drain()
+		return await loop.sendfile(self.writer.transport, f, offset, size)
+
+class AsyncHandler:
+	responses = http.server.BaseHTTPRequestHandler.responses
+
+	def __init__(self, writer, command, path, requestVersion, headers):
+		self.command = command
+		self.path = path
+		self.request_version = requestVersion
+		self.headers = headers
+		self.client_address = writer.get_extra_info('peername')
+		self.wfile = Writer(writer)
+		self._headers = []
+
+		connection = (headers.get('Connection') or '').lower()
+		if requestVersion == 'HTTP/1.1':
+			self.close_connection = connection == 'close'
+		else:
+			self.close_connection = connection != 'keep-alive'
+
+	def sendfile(self, f, offset, size):
+		return asyncio.run_coroutine_threadsafe(self.wfile.sendfile(f, offset, size), loop).result()
+
+	def send_response(self, code, message = None):
+		if message is None:
+			message = self.responses[code][0] if code in self.responses else ''
+		self._headers.append(('HTTP/1.1 %d %s\r\n' % (code, message)).encode('latin-1'))
+		self.send_header('Server', 'nut')
+		self.send_header('Date', time.strftime('%a, %d %b %Y %H:%M:%S GMT', time.gmtime()))
+
+	def send_header(self, keyword, value):
+		self._headers.append(('%s: %s\r\n' % (keyword, value)).encode('latin-1', 'strict'))
+
+		if keyword.lower() == 'connection' and value.lower() == 'close':
+			self.close_connection = True
+
+	def end_headers(self):
+		self._headers.append(b'\r\n')
+		self.wfile.write(b''.join(self._headers))
+		self._headers = []
+
+async def readRequest(reader):
+	requestLine = await reader.readline()
+	if not requestLine:
+		return None
+
+	bits = requestLine.decode('iso-8859-1').rstrip('\r\n').split()
+	if len(bits) != 3:
+		raise IOError('bad request line')
+
+	lines = []
+	while True:
+		line = await reader.readline()
+		if line in (b'\r\n', b'\n', b''):
+			break
+		lines.append(line)
+
+		if len(lines) > 100:
+			raise IOError('too many headers')
+
+	headers = http.client.parse_headers(io.BytesIO(b''.join(lines) + b'\r\n'))
+	return bits[0], bits[1], bits[2], headers
+
+async def handleConnection(reader, writer):
+	try:
+		# persistent connection, requests are served one after the other until the client closes or goes idle
+		while True:
+			try:
+				r = await asyncio.wait_for(readRequest(reader), Config.server.idleTimeout)
+			except asyncio.TimeoutError:
+				break
+
+			if not r:
+				break
+
+			command, path, version, headers = r
+			handler = AsyncHandler(writer, command, path, version, headers)
+
+			if command == 'GET':
+				await loop.run_in_executor(pool, Server.serve, handler, False)
+			elif command == 'HEAD':
+				await loop.run_in_executor(pool, Server.serve, handler, True)
+			else:
+				handler.send_response(501)
+				handler.send_header('Content-Length', '0')
+				handler.send_header('Connection', 'close')
+				await loop.run_in_executor(pool, handler.end_headers)
+
+			if handler.close_connection:
+				break
+	except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+		pass
+	except BaseException as e:
+		Print.error('async server error: ' + str(e))
+	finally:
+		try:
+			writer.close()
+		except:
+			pass
+
+async def main(addr):
+	global loop
+	loop = asyncio.get_running_loop()
+
+	server = await asyncio.start_server(handleConnection, addr[0], addr[1], reuse_address = True, backlog = 128)
+	async with server:
+		await server.serve_forever()
+
+def run(addr):
+	global pool
+	pool = concurrent.futures.ThreadPoolExecutor(max_workers = max(Config.server.workers, 1))
+
+	try:
+		asyncio.run(main(addr))
+	finally:
+		pool.shutdown(wait = False)
@@ -10,6 +10,13 @@ import Hex
 import socket
 import struct
 import time
+import gzip
+import hashlib
+import threading
+import email.utils
+import Thumbnails
+import Fs
+from binascii import hexlify as hx
 
 try:
 	from PIL import Image
@@ -18,10 +25,81 @@ except ImportError:
 import Server
 import os
 
+# key -> {'generation', 'etag', 'body', 'gzip'}, see cachedJson()
+global jsonCache
+jsonCache = {}
+jsonCacheLock = threading.Lock()
+jsonCacheLimit = 256
+# key -> Lock held while that key is rebuilt, so a slow build only holds up requests for the same key
+global jsonBuildLocks
+jsonBuildLocks = {}
+
+def generation():
+	return (Titles.generation, Nsps.generation)
+
+def cachedJson(request, response, key, build):
+	# serves json.dumps(build()), rebuilt only when Titles or Nsps changed since it was cached
+	gen = generation()
+
+	with jsonCacheLock:
+		entry = jsonCache.get(key)
+
+		if entry is None or entry['generation'] != gen:
+			buildLock = jsonBuildLocks.setdefault(key, threading.Lock())
+
+	if entry is None or entry['generation'] != gen:
+		with buildLock:
+			# another request may have rebuilt it while we waited
+			with jsonCacheLock:
+				entry = jsonCache.get(key)
+
+			if entry is None or entry['generation'] != gen:
+				body = json.dumps(build()).encode('utf-8')
+				entry = {'generation': gen, 'etag': hashlib.sha1(body).hexdigest(), 'body': body, 'gzip': gzip.compress(body)}
+
+				with jsonCacheLock:
+					if len(jsonCache) >= jsonCacheLimit:
+						for k in [k for k, v in jsonCache.items() if v['generation'] != gen]:
+							del jsonCache[k]
+							jsonBuildLocks.pop(k, None)
+
+						if len(jsonCache) >= jsonCacheLimit:
+							jsonCache.clear()
+							jsonBuildLocks.clear()
+
+					jsonCache[key] = entry
+
+	useGzip = 'gzip' in (request.headers.get('Accept-Encoding') or '')
+	etag = '"%s%s"' % (entry['etag'], '-gz' if useGzip else '')
+
+	response.headers['Content-type'] = 'application/json'
+	response.headers['ETag'] = etag
+	response.headers['Cache-Control'] = 'no-cache'
+	response.headers['Vary'] = 'Accept-Encoding'
+
+	ifNoneMatch = request.headers.get('If-None-Match')
+	if ifNoneMatch:
+		tags = [t.strip() for t in ifNoneMatch.split(',')]
+		tags = [t[2:] if t.startswith('W/') else t for t in tags]
+
+		if '*' in tags or '"%s"' % entry['etag'] in tags or '"%s-gz"' % entry['etag'] in tags:
+			response.setStatus(304)
+			return
+
+	if useGzip:
+		response.headers['Content-Encoding'] = 'gzip'
+		response.write(entry['gzip'])
+	else:
+		response.write(entry['body'])
+
 def getUser(request, response):
 	response.write(json.dumps(request.user.__dict__))
 
 def getSearch(request, response):
+	key = ('search',) + tuple(sorted((k, tuple(v)) for k, v in request.query.items()))
+	cachedJson(request, response, key, lambda: search(request))
+
+def search(request):
 	o = []
 
 	region = request.query.get('region')
@@ -43,14 +121,44 @@ def getSearch(request, response):
 		f = t.getLatestFile()
 		if f and f.hasValidTicket and (region == None or t.region in region) and (dlc == None or t.isDLC == dlc) and (update == None or t.isUpdate == update) and (demo == None or t.isDemo == demo) and (publisher == None or t.publisher in publisher):
 			o.append({'id': t.id, 'name': t.name, 'version': int(f.version) if f.version else None , 'region': t.region,'size': f.getFileSize(), 'mtime': f.getFileModified() })
-	response.write(json.dumps(o))
+	return o
 
 def getTitles(request, response):
+	cachedJson(request, response, ('titles',), titles)
+
+def titles():
 	o = []
 	map = ['id', 'key', 'isUpdate', 'isDLC', 'isDemo', 'name', 'version', 'region', 'baseId']
 	for k, t in Titles.items():
 		o.append(t.__dict__)
-	response.write(json.dumps(o))
+	return o
+
+def sendImage(request, response, path):
+	if not path:
+		return Server.Response404(request, response)
+
+	if not os.path.isfile(path):
+		return Server.Response500(request, response)
+
+	with open(path, 'rb') as f:
+		stat = os.fstat(f.fileno())
+
+		response.setMime(path)
+		response.headers['Cache-Control'] = 'max-age=31536000'
+		response.headers['Last-Modified'] = email.utils.formatdate(stat.st_mtime, usegmt=True)
+
+		try:
+			if email.utils.parsedate_to_datetime(request.headers.get('If-Modified-Since')).timestamp() >= int(stat.st_mtime):
+				response.setStatus(304)
+				return
+		except:
+			pass
+
+		response.headers['Content-Length'] = str(stat.st_size)
+		response.sendHeader()
+
+		if not response.head:
+			response.sendFile(f, 0, stat.st_size)
 
 def getTitleImage(request, response):
 	if len(request.bits) < 3:
@@ -69,19 +177,8 @@ def getTitleImage(request, response):
 	if not Titles.contains(id):
 		return Server.Response404(request, response)
 
-	path = Titles.get(id).iconFile(width) or Titles.get(id).frontBoxArtFile(width)
-
-	if not path:
-		return Server.Response404(request, response)
-
-	response.setMime(path)
-	response.headers['Cache-Control'] = 'max-age=31536000'
-
-	if os.path.isfile(path):
-		with open(path, 'rb') as f:
-			response.write(f.read())
-
-	return Server.Response500(request, response)
+	path = Thumbnails.get(id, 'icon', width)
+	return sendImage(request, response, path)
 
 def getBannerImage(request, response):
 	if len(request.bits) < 3:
@@ -92,19 +189,8 @@ def getBannerImage(request, response):
 	if not Titles.contains(id):
 		return Server.Response404(request, response)
 
-	path = Titles.get(id).bannerFile()
-
-	if not path:
-		return Server.Response404(request, response)
-
-	response.setMime(path)
-	response.headers['Cache-Control'] = 'max-age=31536000'
-
-	if os.path.isfile(path):
-		with open(path, 'rb') as f:
-			response.write(f.read())
-
-	return Server.Response500(request, response)
+	path = Thumbnails.get(id, 'banner')
+	return sendImage(request, response, path)
 
 def getFrontArtBoxImage(request, response):
 	if len(request.bits) < 3:
@@ -119,19 +205,8 @@ def getFrontArtBoxImage(request, response):
 	if not Titles.contains(id):
 		return Server.Response404(request, response)
 
-	path = Titles.get(id).frontBoxArtFile()
-
-	if not path:
-		return Server.Response404(request, response)
-
-	response.setMime(path)
-	response.headers['Cache-Control'] = 'max-age=31536000'
-
-	if os.path.isfile(path):
-		with open(path, 'rb') as f:
-			response.write(f.read())
-
-	return Server.Response500(request, response)
+	path = Thumbnails.get(id, 'frontBoxArt')
+	return sendImage(request, response, path)
 
 def getScreenshotImage(request, response):
 	if len(request.bits) < 3:
@@ -147,19 +222,8 @@ def getScreenshotImage(request, response):
 	if not Titles.contains(id):
 		return Server.Response404(request, response)
 
-	path = Titles.get(id).screenshotFile(i)
-
-	if not path:
-		return Server.Response404(request, response)
-
-	response.setMime(path)
-	response.headers['Cache-Control'] = 'max-age=31536000'
-
-	if os.path.isfile(path):
-		with open(path, 'rb') as f:
-			response.write(f.read())
-
-	return Server.Response500(request, response)
+	path = Thumbnails.get(id, 'screenshot%d' % i)
+	return sendImage(request, response, path)
 
 def getPreload(request, response):
 	Titles.queue.add(request.bits[2])
@@ -196,6 +260,117 @@ def getInfo(request, response):
 	except BaseException as e:
 		response.write(json.dumps({'success': False, 'message': str(e)}))
 
+def parseRange(header, size):
+	# RFC 7233 byte ranges as a list of (start, end) with end exclusive.
+	# [] means nothing is satisfiable (416), None means the header is invalid and must be ignored
+	units, sep, spec = header.partition('=')
+	if not sep or units.strip().lower() != 'bytes':
+		return None
+
+	ranges = []
+	for r in spec.split(','):
+		r = r.strip()
+		if not r:
+			continue
+
+		first, sep, last = r.partition('-')
+		first = first.strip()
+		last = last.strip()
+
+		if not sep or not (first.isdigit() or first == '') or not (last.isdigit() or last == '') or (first == '' and last == ''):
+			return None
+
+		if first == '':
+			# suffix range, the last n bytes
+			n = int(last)
+			if n > 0 and size > 0:
+				ranges.append((max(size - n, 0), size))
+			continue
+
+		start = int(first)
+		end = int(last) + 1 if last != '' else size
+
+		if last != '' and end <= start:
+			return None
+
+		if start < size:
+			ranges.append((start, min(end, size)))
+
+	# a few slices of one file is all installers need, anything beyond that is served as a whole
+	if len(ranges) > 64:
+		return None
+
+	return ranges
+
+def sendByteRanges(response, f, ranges, size, transfer = None, base = 0):
+	contentType = response.headers.get('Content-type', 'application/octet-stream')
+	boundary = hx(os.urandom(16)).decode()
+
+	parts = []
+	for start, end in ranges:
+		parts.append(('\r\n--%s\r\nContent-Type: %s\r\nContent-Range: bytes %d-%d/%d\r\n\r\n' % (boundary, contentType, start, end - 1, size)).encode())
+	tail = ('\r\n--%s--\r\n' % boundary).encode()
+
+	response.setStatus(206)
+	response.setHeader('Accept-Ranges', 'bytes')
+	response.setHeader('Content-type', 'multipart/byteranges; boundary=' + boundary)
+	response.setHeader('Content-Length', str(sum(len(p) for p in parts) + sum(end - start for start, end in ranges) + len(tail)))
+	response.sendHeader()
+
+	if not response.head:
+		for part, (start, end) in zip(parts, ranges):
+			response.write(part)
+			(transfer or response).sendFile(f, base + start, end - start)
+		response.write(tail)
+
+def sendRanges(request, response, f, size, base = 0, desc = None, id = None, start = None, end = None):
+	# serves the size bytes of f found at base, honouring the Range header
+	ranges = None
+
+	if 'Range' in request.headers:
+		ranges = parseRange(request.headers.get('Range'), size)
+
+		if ranges == []:
+			response.setStatus(416)
+			response.setHeader('Content-Range', 'bytes */%d' % size)
+			return
+
+	if ranges and len(ranges) > 1:
+		with Server.Transfers.start(request, response, 0 if response.head else sum(end - start for start, end in ranges), desc, id) as transfer:
+			return sendByteRanges(response, f, ranges, size, transfer, base)
+
+	if ranges:
+		start, end = ranges[0]
+		response.setStatus(206)
+
+	else:
+		if start == None:
+			start = 0
+		if end == None:
+			end = size
+
+	if end >= size:
+		end = size
+
+		if end <= start:
+			response.write(b'')
+			return
+
+	print('ranged request for %d - %d' % (start, end))
+
+	response.setHeader('Accept-Ranges', 'bytes')
+	response.setHeader('Content-Range', 'bytes %s-%s/%s' % (start, end-1, size))
+	response.setHeader('Content-Length', str(end - start))
+	#Print.info(response.headers['Content-Range'])
+
+	if response.head:
+		response.sendHeader()
+		return
+
+	with Server.Transfers.start(request, response, end - start, desc, id) as transfer:
+		response.sendHeader()
+		transfer.sendFile(f, base + start, end - start)
+
 def getDownload(request, response, start = None, end = None):
 	try:
 		nsp = Nsps.getByTitleId(request.bits[2])
@@ -205,70 +380,71 @@ def getDownload(request, response, start = None, end = None):
 			start = int(request.bits[3])
 			end = int(request.bits[4])
 	
-		chunkSize = 0x400000
-
 		with open(nsp.path, "rb") as f:
 			f.seek(0, 2)
 			size = f.tell()
-			if 'Range' in request.headers:
-				start, end = request.headers.get('Range').strip().strip('bytes=').split('-')
 
-				if end == '':
-					end = size - 1
-				else:
-					end = int(end) + 1
+			response.setMime(nsp.path)
+			sendRanges(request, response, f, size, 0, 'Serving ' + nsp.titleId, nsp.titleId, start, end)
+	except Server.Transfers.Busy:
+		Server.Response503(request, response)
+		return
+	except BaseException as e:
+		Print.error('NSP download exception: ' + str(e))
+
+		if response.headersSent:
+			# part of the body is out, the server has to drop the connection
+			raise
+	if response.bytesSent == 0:
+		response.write(b'')
+
+def getEntry(request, response):
+	# /api/entry/<titleId>/<name>[/<section>], a file inside the title's NSP (or the secure partition of an XCI),
+	# served straight from the container. with a section index the NCA section is served decrypted.
+	nsp = Nsps.getByTitleId(request.bits[2])
 
-				if start == '':
-					start = size - end
-				else:
-					start = int(start)
+	if not nsp:
+		return Server.Response404(request, response)
 
-				if start >= size or end > size or start < 0 or end <= 0:
-					return Server.Response400(request, response, 'Invalid range request')
+	name = request.bits[3]
+	container = Fs.factory(nsp.path)
 
-				response.setStatus(206)
+	try:
+		container.open(nsp.path, 'rb')
+		fs = container.hfs0['secure'] if isinstance(container, Fs.Xci) else container
 
-			else:
-				if start == None:
-					start = 0
-				if end == None:
-					end = size
+		index = [i for i, entry in enumerate(fs.entries) if entry.name == name]
 
-			if end >= size:
-				end = size
+		if not index:
+			return Server.Response404(request, response)
 
-				if end <= start:
-					response.write(b'')
-					return
+		entry = fs.entries[index[0]]
+		response.attachFile(name)
+		response.setHeader('Content-type', 'application/octet-stream')
 
-			print('ranged request for %d - %d' % (start, end))
-			f.seek(start, 0)
+		if len(request.bits) >= 5:
+			try:
+				section = fs.getFile(index[0])[int(request.bits[4])]
+			except (IndexError, ValueError, TypeError):
+				return Server.Response404(request, response)
 
-			response.setMime(nsp.path)
-			response.setHeader('Accept-Ranges', 'bytes')
-			response.setHeader('Content-Range', 'bytes %s-%s/%s' % (start, end-1, size))
-			response.setHeader('Content-Length', str(end - start))
-			#Print.info(response.headers['Content-Range'])
-			response.sendHeader()
-
-			if not response.head:
-				size = end - start
-
-				i = 0
-
-				while i < size:
-					chunk = f.read(min(size-i, chunkSize))
-					i += len(chunk)
-
-					if chunk:
-						pass
-						response.write(chunk)
-					else:
-						break
-	except BaseException as e:
-		Print.error('NSP download exception: ' + str(e))
-	if response.bytesSent == 0:
-		response.write(b'')
+			response.attachFile('%s.%s' % (name, request.bits[4]))
+			response.setHeader('Content-type', 'application/octet-stream')
+			return sendRanges(request, response, section, section.size, 0, 'Serving ' + name, nsp.titleId)
+
+		# unencrypted containers let the raw entry go out through sendfile(), otherwise it is read through the Fs stack
+		root = fs.rootOffset(entry.offset)
+
+		if root:
+			f, base = root
+		else:
+			f, base = fs.partition(entry.offset, entry.size), 0
+
+		sendRanges(request, response, f, entry.size, base, 'Serving ' + name, nsp.titleId)
+	except Server.Transfers.Busy:
+		Server.Response503(request, response)
+	finally:
+		container.close()
 
 def getQueue(request, response):
 	r = Status.data().copy()
@@ -288,6 +464,9 @@ def getTitleUpdates(request, response):
 	response.write(json.dumps(r))
 
 def getFiles(request, response):
+	cachedJson(request, response, ('files',), files)
+
+def files():
 	r = {}
 	for path, nsp in Nsps.files.items():
 		if Titles.contains(nsp.titleId):
@@ -300,4 +479,4 @@ def getFiles(request, response):
 				r[title.baseId]['update'].append(nsp.dict())
 			else:
 				r[title.baseId]['base'].append(nsp.dict())
-	response.write(json.dumps(r))
\ No newline at end of file
+	return r
\ No newline at end of file
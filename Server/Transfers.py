@@ -0,0 +1,211 @@
+import threading
+import queue
+import time
+import Config
+import Status
+
+# paces file transfers served by the api so one fast client (or a library backup) can not starve the others.
+# every transfer draws from the global bucket and from its user's bucket, chunk by chunk, and only
+# Config.server.maxTransfers of them run at once. rates are in bytes per second, 0 means unlimited.
+
+class TokenBucket:
+	def __init__(self, rate):
+		self.rate = rate
+		self.tokens = 0
+		self.timestamp = time.perf_counter()
+		self.lock = threading.Lock()
+
+	def consume(self, n):
+		# takes n tokens, going into debt if needed, and sleeps until the debt is paid off.
+		# callers queue up behind the debt, so concurrent transfers get an equal share of the rate
+		rate = self.rate() if callable(self.rate) else self.rate
+
+		if not rate or rate <= 0:
+			return
+
+		with self.lock:
+			now = time.perf_counter()
+			# allow at most a quarter second of burst
+			self.tokens = min(self.tokens + (now - self.timestamp) * rate, rate / 4)
+			self.timestamp = now
+			self.tokens -= n
+			wait = -self.tokens / rate
+
+		if wait > 0:
+			time.sleep(wait)
+
+global bucket
+global userBuckets
+global active
+bucket = TokenBucket(lambda: Config.server.maxRate)
+userBuckets = {}
+active = []
+lock = threading.Condition()
+
+# transfers below this size (installers probing headers, small ranges) get no status bar
+statusMinSize = 0x100000
+
+class Busy(IOError):
+	pass
+
+def userBucket(user):
+	id = user.id if user else None
+
+	with lock:
+		if not id in userBuckets:
+			userBuckets[id] = TokenBucket(lambda: Config.server.maxUserRate)
+		return userBuckets[id]
+
+def lowestRate():
+	rates = [r for r in (Config.server.maxRate, Config.server.maxUserRate) if r > 0]
+	return min(rates) if rates else 0
+
+class Transfer:
+	def __init__(self, request, response, size, desc = None, id = None):
+		self.request = request
+		self.response = response
+		self.size = size
+		self.desc = desc
+		self.id = id
+		self.status = None
+		self.bucket = userBucket(request.user)
+
+	def __enter__(self):
+		with lock:
+			if Config.server.maxTransfers > 0 and not lock.wait_for(lambda: len(active) < Config.server.maxTransfers, Config.server.transferTimeout):
+				raise Busy('too many transfers')
+			active.append(self)
+
+		try:
+			if self.size and self.size >= statusMinSize:
+				self.status = Status.create(self.size, self.desc)
+				self.status.id = self.id
+		except BaseException:
+			# __exit__ is not called when __enter__ raises, the slot would never be given back
+			self.release()
+			raise
+
+		return self
+
+	def __exit__(self, type, value, traceback):
+		if self.status:
+			self.status.close()
+
+		self.release()
+
+	def release(self):
+		with lock:
+			active.remove(self)
+			lock.notify()
+
+	def sendFile(self, f, offset, size, chunkSize = 0x40000):
+		# same contract as NutResponse.sendFile, in chunks so the transfer's status stays live, paced when a rate limit is configured
+		rate = lowestRate()
+
+		if not hasattr(f, 'fileno'):
+			return self.sendStream(f, offset, size, rate)
+
+		if rate:
+			# about ten chunks per second, so transfers sharing a bucket interleave finely
+			chunkSize = min(chunkSize, max(0x4000, rate // 10))
+
+		i = 0
+		while i < size:
+			n = min(size - i, chunkSize)
+
+			if rate:
+				bucket.consume(n)
+				self.bucket.consume(n)
+
+			n = self.response.sendFile(f, offset + i, n)
+			if not n:
+				raise IOError('file ended after %d of %d bytes' % (i, size))
+
+			self.add(n)
+			i += n
+
+		return i
+
+	def sendStream(self, f, offset, size, rate):
+		# Fs files (partitions decrypted on the fly) can not be sendfile()'d, they are read ahead on a background thread
+		reader = ReadAhead(f, offset, size, min(0x100000, max(0x4000, rate // 10)) if rate else 0x100000)
+		i = 0
+
+		try:
+			for chunk in reader:
+				if rate:
+					bucket.consume(len(chunk))
+					self.bucket.consume(len(chunk))
+
+				self.response.write(chunk)
+				self.add(len(chunk))
+				i += len(chunk)
+		finally:
+			reader.close()
+
+		if i < size:
+			raise IOError('file ended after %d of %d bytes' % (i, size))
+
+		return i
+
+	def add(self, n):
+		if self.status:
+			self.status.add(n)
+
+class ReadAhead:
+	# reads size bytes of f from offset on its own thread, keeping up to depth chunks ready for the consumer
+	def __init__(self, f, offset, size, chunkSize = 0x100000, depth = 4):
+		self.f = f
+		self.offset = offset
+		self.size = size
+		self.chunkSize = chunkSize
+		self.queue = queue.Queue(depth)
+		self.stopped = False
+		self.thread = threading.Thread(target = self.run)
+		self.thread.daemon = True
+		self.thread.start()
+
+	def run(self):
+		try:
+			self.f.seek(self.offset)
+			i = 0
+
+			while i < self.size and not self.stopped:
+				buf = bytearray(min(self.size - i, self.chunkSize))
+				n = self.f.readinto(buf)
+
+				if not n:
+					break
+
+				del buf[n:]
+				self.queue.put(buf)
+				i += n
+		except BaseException as e:
+			self.queue.put(e)
+		finally:
+			self.queue.put(None)
+
+	def __iter__(self):
+		while True:
+			chunk = self.queue.get()
+
+			if chunk is None:
+				return
+
+			if isinstance(chunk, BaseException):
+				raise chunk
+
+			yield chunk
+
+	def close(self):
+		# unblocks and waits for the reader thread so nobody touches f after we return
+		self.stopped = True
+
+		while self.thread.is_alive():
+			try:
+				self.queue.get(timeout = 0.1)
+			except queue.Empty:
+				pass
+
+def start(request, response, size, desc = None, id = None):
+	return Transfer(request, response, size, desc, id)
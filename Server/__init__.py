@@ -10,11 +10,12 @@ import re
 import Print
 import urllib
 import Users
-import base64
 from urllib.parse import urlparse
 from urllib.parse import parse_qs
 
 import Server.Controller.Api
+import Server.AsyncServer
+import Server.Transfers
 
 
 global httpd
@@ -26,7 +27,6 @@ mimes = {}
 httpd = None
 sock = None
 addr = None
-threads = []
 
 mappings = {'api': Server.Controller.Api}
 
@@ -37,24 +37,11 @@ mimes = {
 		'.png': 'image/png',
 		'.nsx': 'application/octet-stream',
 		'.nsp': 'application/octet-stream',
+		'.nca': 'application/octet-stream',
+		'.xci': 'application/octet-stream',
 		'.jpg': 'image/jpeg'
 	}
 
-class Thread(threading.Thread):
-	def __init__(self, i):
-		threads.append(self)
-		threading.Thread.__init__(self)
-		self.i = i
-		self.daemon = True
-		self.start()
-	def run(self):
-		httpd = http.server.HTTPServer(addr, NutHandler, False)
-
-		httpd.socket = sock
-		httpd.server_bind = self.server_close = lambda self: None
-
-		httpd.serve_forever()
-
 def run():
 	global httpd
 	global sock
@@ -63,14 +50,14 @@ def run():
 	Print.info(time.asctime() + ' Server Starts - %s:%s' % (Config.server.hostname, Config.server.port))
 	try:
 		addr = (Config.server.hostname, Config.server.port)
-		sock = socket.socket (socket.AF_INET, socket.SOCK_STREAM)
-		sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-		sock.bind(addr)
-		sock.listen(5)
-
-		[Thread(i) for i in range(16)]
-		for thread in threads:
-			thread.join()
+		if Config.server.engine == 'asyncio':
+			Server.AsyncServer.run(addr)
+		else:
+			# a thread per connection: an idle keep-alive connection only ever holds its own thread
+			httpd = http.server.ThreadingHTTPServer(addr, NutHandler)
+			httpd.daemon_threads = True
+			sock = httpd.socket
+			httpd.serve_forever()
 	except KeyboardInterrupt:
 		pass
 
@@ -99,6 +86,7 @@ class NutResponse:
 		self.head = False
 		self.headersSent = False
 		self.headers = {'Content-type': 'text/html'}
+		self.buffer = []
 
 	def setHead(self, h):
 		self.head = h
@@ -131,20 +119,73 @@ class NutResponse:
 		for k,v in self.headers.items():
 			self.handler.send_header(k, v)
 
+		if not 'Content-Length' in self.headers and self.status != 304:
+			# the body can only be delimited by closing the connection
+			self.handler.send_header('Connection', 'close')
+
 		self.handler.end_headers()
 		self.headersSent = True
 
 	def write(self, data):
-		if self.bytesSent == 0 and not self.headersSent:
-			self.sendHeader()
-
 		if type(data) == str:
 			data = data.encode('utf-8')
 
 		self.bytesSent += len(data)
 
+		if not self.headersSent:
+			# held back until the handler returns so the response gets a Content-Length, see finish()
+			self.buffer.append(bytes(data))
+			return len(data)
+
 		return self.handler.wfile.write(data)
 
+	def finish(self):
+		if not self.headersSent:
+			body = b''.join(self.buffer)
+			self.buffer = []
+
+			# a 304 never has a body, its Content-Length would have to describe the 200 response
+			if self.status != 304:
+				self.headers['Content-Length'] = str(len(body))
+			self.sendHeader()
+
+			if not self.head and self.status != 304:
+				self.handler.wfile.write(body)
+
+	def isComplete(self):
+		# whether the body matches the Content-Length that went out, another response must not follow a short one
+		if not self.headersSent or self.head or self.status == 304 or not 'Content-Length' in self.headers:
+			return True
+
+		return self.bytesSent >= int(self.headers['Content-Length'])
+
+	def sendFile(self, f, offset, size, chunkSize = 0x400000):
+		# streams size bytes of f from offset, straight from the file descriptor to the socket when the handler can
+		if self.bytesSent == 0 and not self.headersSent:
+			self.sendHeader()
+
+		sendfile = getattr(getattr(self, 'handler', None), 'sendfile', None)
+		if sendfile:
+			n = sendfile(f, offset, size)
+			self.bytesSent += n
+			return n
+
+		f.seek(offset)
+		i = 0
+		buf = bytearray(min(chunkSize, size) or 1)
+		view = memoryview(buf)
+
+		while i < size:
+			n = f.readinto(view[:min(size-i, chunkSize)])
+
+			if not n:
+				break
+
+			self.write(view[:n])
+			i += n
+
+		return i
+
 def Response400(request, response, error='400'):
 	response.setStatus(400)
 	response.write(error)
@@ -157,6 +198,13 @@ def Response500(request, response):
 	response.setStatus(500)
 	response.write('500')
 
+def Response503(request, response, retryAfter = 10):
+	response.setStatus(503)
+	response.headers['Retry-After'] = str(retryAfter)
+	response.headers.pop('Content-Length', None)
+	response.headers.pop('Content-Range', None)
+	response.write('503')
+
 def Response401(request, response):
 	response.setStatus(401)
 	response.headers['WWW-Authenticate'] = 'Basic realm=\"Nut\"'
@@ -174,72 +222,73 @@ def route(request, response):
 			return True
 	except BaseException as e:
 		print(str(e))
-		return None
+		raise
 	return False
 
-class NutHandler(http.server.BaseHTTPRequestHandler):
-	def __init__(self, *args):
-		self.basePath = os.path.abspath('.')
-		super(NutHandler, self).__init__(*args)
-
-	def do_HEAD(self):
-		request = NutRequest(self)
-		response = NutResponse(self)
-		request.setHead(True)
-		response.setHead(True)
-		
-		if self.headers['Authorization'] == None:
-			return Response401(request, response)
+def serve(handler, head = False):
+	# shared by both server engines, handler provides headers, path, client_address, send_response / send_header / end_headers and wfile
+	request = NutRequest(handler)
+	response = NutResponse(handler)
+	request.setHead(head)
+	response.setHead(head)
 
-		id, password = base64.b64decode(self.headers['Authorization'].split(' ')[1]).decode().split(':')
+	request.user = Users.authHeader(handler.headers['Authorization'], handler.client_address[0])
 
-		request.user = Users.auth(id, password, self.client_address[0])
+	failed = False
 
+	try:
 		if not request.user:
-			return Response401(request, response)
-		
-		try:
-			if len(request.bits) > 0 and request.bits[0] in mappings:
-				i = request.bits[1]
-				methodName = 'get' + i[0].capitalize() + i[1:]
-				method = getattr(mappings[request.bits[0]], methodName, Response404)
-				method(request, response)
-			else:
-				self.handleFile(request, response)
-		except BaseException as e:
-				self.wfile.write(Response500(request, response))
+			Response401(request, response)
+		elif not route(request, response):
+			handleFile(request, response)
+	except BaseException as e:
+		if not response.headersSent:
+			response.buffer = []
+			Response500(request, response)
+		else:
+			failed = True
 
-	def do_GET(self):
-		request = NutRequest(self)
-		response = NutResponse(self)
-		
-		if self.headers['Authorization'] == None:
-			return Response401(request, response)
+	response.finish()
 
-		id, password = base64.b64decode(self.headers['Authorization'].split(' ')[1]).decode().split(':')
+	if failed or not response.isComplete():
+		# the client can not tell where this body ends, the connection is all that can delimit it
+		handler.close_connection = True
 
-		request.user = Users.auth(id, password, self.client_address[0])
+def handleFile(request, response):
+	basePath = os.path.abspath('.')
+	path = os.path.abspath('public_html' + request.path)
+	if not path.startswith(basePath):
+		raise IOError('invalid path requested: ' + basePath + ' vs ' + path)
 
-		if not request.user:
-			return Response401(request, response)
+	if os.path.isdir(path):
+		path += '/index.html'
 
-		try:
-			if not route(request, response):
-				self.handleFile(request, response)
-		except BaseException as e:
-				self.wfile.write(Response500(request, response))
+	if not os.path.isfile(path):
+		return Response404(request, response)
+	response.setMime(path)
+	with open(path, 'rb') as f:
+		response.write(f.read())
 
+class NutHandler(http.server.BaseHTTPRequestHandler):
+	protocol_version = 'HTTP/1.1'
 
-	def handleFile(self, request, response):
-		path = os.path.abspath('public_html' + self.path)
-		if not path.startswith(self.basePath):
-			raise IOError('invalid path requested: ' + self.basePath + ' vs ' + path)
+	def __init__(self, *args):
+		self.timeout = Config.server.idleTimeout
+		self.basePath = os.path.abspath('.')
+		super(NutHandler, self).__init__(*args)
+
+	def setup(self):
+		super(NutHandler, self).setup()
+		# headers and body go out in separate writes, on a kept alive connection Nagle would hold the body back
+		# until the client's delayed ACK of the headers
+		self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
 
-		if os.path.isdir(path):
-			path += '/index.html'
+	def sendfile(self, f, offset, size):
+		self.wfile.flush()
+		return self.connection.sendfile(f, offset, size)
 
-		if not os.path.isfile(path):
-			return Response404(request, response)
-		response.setMime(path)
-		with open(path, 'rb') as f:
-			response.write(f.read())
\ No newline at end of file
+	def do_HEAD(self):
+		serve(self, True)
+
+	def do_GET(self):
+		serve(self)
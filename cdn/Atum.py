@@ -24,6 +24,7 @@ import urllib3
 import Print
 import Status
 import Config
+import cdn
 
 quiet = False
 truncateName = False
@@ -45,7 +46,7 @@ def makeRequest(method, url, certificate='', hdArgs={}):
 	}
 	reqHd.update(hdArgs)
 
-	r = requests.request(method, url, cert=certificate, headers=reqHd, verify=False, stream=True)
+	r = cdn.request(method, url, cert=certificate, headers=reqHd)
 
 	if r.status_code == 403:
 		raise IOError('Request rejected by server! Check your cert')
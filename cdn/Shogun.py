@@ -43,7 +43,7 @@ def makeRequest(method, url, hdArgs={}):
 
 	reqHd.update(hdArgs)
 
-	r = requests.request(method, url, cert='ShopN.pem', headers=reqHd, verify=False, stream=True)
+	r = cdn.request(method, url, cert='ShopN.pem', headers=reqHd)
 
 	if r.status_code == 403:
 		raise IOError('Request rejected by server! Check your cert ' + r.text)
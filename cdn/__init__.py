@@ -1,5 +1,54 @@
 import time
 import os
+import threading
+import requests
+from urllib.parse import urlparse
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import Config
+
+# one keep-alive session per (scheme, host, client cert), shared by every thread talking to that host,
+# so a version sweep pays for the tls client cert handshake once per pooled connection instead of once per request
+global sessions
+sessions = {}
+sessionLock = threading.Lock()
+
+def poolSize():
+	# enough for every concurrent request to one host: scrape threads, or every segment of every nca being downloaded
+	return Config.cdn.poolSize or max(Config.threads, Config.scrapeThreads, Config.download.ncaThreads * max(Config.download.segments, 1))
+
+def retryPolicy():
+	# connection errors and transient server errors are retried with exponential backoff, for idempotent methods only
+	kwargs = {'total': Config.cdn.retries, 'backoff_factor': Config.cdn.backoff, 'status_forcelist': (429, 500, 502, 503, 504), 'raise_on_status': False}
+
+	try:
+		return Retry(allowed_methods = frozenset(['HEAD', 'GET']), **kwargs)
+	except TypeError:
+		# urllib3 < 1.26
+		return Retry(method_whitelist = frozenset(['HEAD', 'GET']), **kwargs)
+
+def getSession(url, cert = None):
+	u = urlparse(url)
+	key = (u.scheme, u.netloc, cert)
+
+	with sessionLock:
+		if not key in sessions:
+			session = requests.Session()
+			session.mount(u.scheme + '://', HTTPAdapter(pool_connections = 1, pool_maxsize = poolSize(), max_retries = retryPolicy()))
+			session.cert = cert
+			sessions[key] = session
+
+		return sessions[key]
+
+def request(method, url, cert = None, headers = {}, **kwargs):
+	# same as requests.request(..., stream=True) over the pooled session for url's host
+	return getSession(url, cert).request(method, url, headers = headers, verify = False, stream = True, **kwargs)
+
+def closeSessions():
+	with sessionLock:
+		for session in sessions.values():
+			session.close()
+		sessions.clear()
 
 def regions():
 	return ['CO', 'AR', 'CL', 'PE', 'KR', 'HK', 'NZ', 'AT', 'BE', 'CZ', 'DK', 'ES', 'FI', 'GR', 'HU', 'NL', 'NO', 'PL', 'PT', 'RU', 'ZA', 'SE', 'MX', 'IT', 'CA', 'FR', 'DE', 'JP', 'AU', 'GB', 'US']
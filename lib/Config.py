@@ -8,6 +8,28 @@ class Server:
 	def __init__(self):
 		self.hostname = 'localhost'
 		self.port = 9000
+		self.engine = 'threaded'
+		self.workers = 256
+		self.idleTimeout = 30
+		# download pacing, rates in bytes per second, 0 is unlimited
+		self.maxTransfers = 0
+		self.maxRate = 0
+		self.maxUserRate = 0
+		self.transferTimeout = 60
+
+class Fs:
+	def __init__(self):
+		self.pageCacheSize = 0x4000000
+		self.mmap = False
+
+class Scan:
+	def __init__(self):
+		self.threads = 8
+
+class Thumbnails:
+	def __init__(self):
+		self.threads = 4
+		self.widths = [192, 384, 640]
 
 class Cdn:
 	def __init__(self):
@@ -15,6 +37,10 @@ class Cdn:
 		self.firmware = '6.0.0-5.0'
 		self.deviceId = '0000000000000000'
 		self.environment = 'lp1'
+		# http connections kept alive per cdn host, 0 sizes the pool to the scrape threads or the concurrent nca segments, whichever is more
+		self.poolSize = 0
+		self.retries = 3
+		self.backoff = 0.5
 		
 class Paths:
 	def __init__(self):
@@ -88,12 +114,19 @@ class Paths:
 		return f
 		
 class Download:
-	def __init(self):
+	def __init__(self):
 		self.downloadBase = True
 		self.demo = False
 		self.DLC = True
 		self.update = False
 		self.sansTitleKey = False
+		# nca downloads are split in up to this many parallel byte ranges of at least minSegmentSize bytes
+		self.segments = 4
+		self.minSegmentSize = 0x1000000
+		# ncas fetched at once across all download threads
+		self.ncaThreads = 8
+		# nsp repacks are assembled in place: ncas are downloaded straight to their offset in the final file
+		self.streamNsp = False
 
 class EdgeToken:
 	def __init__(self):
@@ -111,7 +144,11 @@ cdn = Cdn()
 paths = Paths()
 download = Download()
 server = Server()
+fs = Fs()
+scan = Scan()
+thumbnails = Thumbnails()
 threads = 4
+scrapeThreads = 16
 jsonOutput = False
 isRunning = True
 
@@ -233,6 +270,51 @@ def load(confFile):
 		except:
 			pass
 
+		try:
+			download.segments = int(j['download']['segments'])
+		except:
+			pass
+
+		try:
+			download.minSegmentSize = int(j['download']['minSegmentSize'])
+		except:
+			pass
+
+		try:
+			download.ncaThreads = int(j['download']['ncaThreads'])
+		except:
+			pass
+
+		try:
+			download.streamNsp = j['download']['streamNsp']
+		except:
+			pass
+
+		try:
+			fs.pageCacheSize = int(j['fs']['pageCacheSize'])
+		except:
+			pass
+
+		try:
+			fs.mmap = j['fs']['mmap']
+		except:
+			pass
+
+		try:
+			scan.threads = int(j['scan']['threads'])
+		except:
+			pass
+
+		try:
+			thumbnails.threads = int(j['thumbnails']['threads'])
+		except:
+			pass
+
+		try:
+			thumbnails.widths = [int(x) for x in j['thumbnails']['widths']]
+		except:
+			pass
+
 		try:
 			cdn.deviceId = j['cdn']['deviceId']
 		except:
@@ -248,6 +330,21 @@ def load(confFile):
 		except:
 			pass
 
+		try:
+			cdn.poolSize = int(j['cdn']['poolSize'])
+		except:
+			pass
+
+		try:
+			cdn.retries = int(j['cdn']['retries'])
+		except:
+			pass
+
+		try:
+			cdn.backoff = float(j['cdn']['backoff'])
+		except:
+			pass
+
 		'''
 		try:
 			cdn.firmware = j['cdn']['firmware']
@@ -269,6 +366,41 @@ def load(confFile):
 			server.port = int(j['server']['port'])
 		except:
 			pass
+
+		try:
+			server.engine = j['server']['engine']
+		except:
+			pass
+
+		try:
+			server.workers = int(j['server']['workers'])
+		except:
+			pass
+
+		try:
+			server.idleTimeout = int(j['server']['idleTimeout'])
+		except:
+			pass
+
+		try:
+			server.maxTransfers = int(j['server']['maxTransfers'])
+		except:
+			pass
+
+		try:
+			server.maxRate = int(j['server']['maxRate'])
+		except:
+			pass
+
+		try:
+			server.maxUserRate = int(j['server']['maxUserRate'])
+		except:
+			pass
+
+		try:
+			server.transferTimeout = int(j['server']['transferTimeout'])
+		except:
+			pass
 	
 		try:
 			for url in j['titleUrls']:
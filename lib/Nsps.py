@@ -9,12 +9,32 @@ import time
 import Print
 import threading
 import json
+import Config
+import concurrent.futures
 
 global files
 files = {}
 
+# entries from files.json whose file no longer exists, a scan matches them against new paths to detect moves
+global missing
+missing = []
+
+# titleId -> [Nsp], kept in sync with files by setFile() / removeFile() / reindexFile()
+global titleIdIndex
+titleIdIndex = {}
+
+# bumped whenever files changes, lets callers cache anything derived from it
+global generation
+generation = 0
+
 global lock
-lock = threading.Lock()
+lock = threading.RLock()
+
+global journal
+global journalSize
+journal = None
+journalSize = 0
+compactThreshold = 1000
 
 global hasScanned
 global hasLoaded
@@ -25,59 +45,187 @@ def get(key):
 	return files[key]
 
 def getByTitleId(id):
-	for k,f in files.items():
-		if f.titleId == id:
-			return f
+	for f in getFilesByTitleId(id):
+		return f
 	return None
+
+def getFilesByTitleId(id):
+	return list(titleIdIndex.get(id, []))
+
+def setFile(path, nsp):
+	old = files.get(path)
+	if old is not None:
+		unindexFile(old)
+	unindexFile(nsp)
+	files[path] = nsp
+	indexFile(nsp)
+	changed()
+
+def removeFile(path):
+	nsp = files.pop(path, None)
+	if nsp is not None:
+		unindexFile(nsp)
+		changed()
+	return nsp
+
+def changed():
+	global generation
+	generation += 1
+
+def indexFile(nsp):
+	# remembers the key it was filed under, the titleId of the nsp may change later
+	nsp.indexedTitleId = nsp.titleId
+	titleIdIndex.setdefault(nsp.titleId, []).append(nsp)
+
+def unindexFile(nsp):
+	if not hasattr(nsp, 'indexedTitleId'):
+		return
+
+	l = titleIdIndex.get(nsp.indexedTitleId, [])
+	if nsp in l:
+		l.remove(nsp)
+		if not l:
+			del titleIdIndex[nsp.indexedTitleId]
+	del nsp.indexedTitleId
+
+def reindexFile(nsp):
+	# called by Fs.Nsp whenever its titleId is assigned (readMeta, setId, setPath), files not in the list are ignored
+	if getattr(nsp, 'indexedTitleId', nsp.titleId) == nsp.titleId:
+		return
+
+	unindexFile(nsp)
+	indexFile(nsp)
+	changed()
 	
+def scanDirectory(path):
+	# lists a single directory, returns its subdirectories and nsp/nsx files
+	dirs = []
+	nsps = []
+
+	with os.scandir(path) as it:
+		for entry in it:
+			try:
+				if entry.is_dir():
+					dirs.append(entry.path)
+				elif entry.is_file() and pathlib.Path(entry.name).suffix in ('.nsp', '.nsx'):
+					st = entry.stat()
+					nsps.append((os.path.abspath(entry.path), st.st_size, st.st_mtime))
+			except OSError:
+				pass
+
+	return dirs, nsps
+
+def walk(base, pool):
+	# directory listings are fanned out to the pool, which is where slow network shares spend their time
+	# returns {path: (size, mtime)} and whether every directory could be listed
+	fileList = {}
+	complete = True
+	pending = {pool.submit(scanDirectory, base)}
+
+	while pending:
+		done, pending = concurrent.futures.wait(pending, return_when = concurrent.futures.FIRST_COMPLETED)
+		for future in done:
+			try:
+				dirs, nsps = future.result()
+			except OSError as e:
+				Print.info('could not list directory: ' + str(e))
+				complete = False
+				continue
+
+			for path, size, mtime in nsps:
+				fileList[path] = (size, mtime)
+			for d in dirs:
+				pending.add(pool.submit(scanDirectory, d))
+
+	return fileList, complete
+
+def scanFile(path, fingerprint):
+	nsp = Fs.Nsp(path, None)
+	nsp.fileSize, nsp.fileModified = fingerprint
+	return nsp
+
 def scan(base):
 	global hasScanned
 	if hasScanned:
 		return
 
 	hasScanned = True
-	i = 0
-
-	fileList = {}
 
 	Print.info(base)
-	for root, dirs, _files in os.walk(base, topdown=False):
-		for name in _files:
-			if pathlib.Path(name).suffix == '.nsp' or pathlib.Path(name).suffix == '.nsx':
-				path = os.path.abspath(root + '/' + name)
-				fileList[path] = name
-
-	if len(fileList) == 0:
-		save()
-		return
 
-	status = Status.create(len(fileList), desc = 'Scanning files...')
+	pool = concurrent.futures.ThreadPoolExecutor(max_workers = max(Config.scan.threads, 1))
 
 	try:
-		for path, name in fileList.items():
-			try:
+		found, complete = walk(base, pool)
+
+		# known files are only re-parsed when their (size, mtime) fingerprint changed
+		fileList = [path for path, fingerprint in found.items() if not path in files or files[path].fingerprint() != fingerprint]
+
+		vanished = {}
+		for nsp in missing:
+			vanished.setdefault(nsp.fingerprint(), []).append(nsp)
+		missing.clear()
+
+		if complete:
+			root = os.path.join(os.path.abspath(base), '')
+			for path, nsp in list(files.items()):
+				if path.startswith(root) and not path in found:
+					removeFile(path)
+					vanished.setdefault(nsp.fingerprint(), []).append(nsp)
+
+		# a new path with the fingerprint of a vanished file is the same file moved, keep its metadata
+		moved = 0
+		for path in list(fileList):
+			fingerprint = found[path]
+			if not path in files and vanished.get(fingerprint):
+				nsp = vanished[fingerprint].pop()
+				nsp.path = path
+				setFile(path, nsp)
+				fileList.remove(path)
+				moved += 1
+
+		removed = sum(len(v) for v in vanished.values())
+		if moved or removed:
+			Print.info('%d files moved, %d files removed' % (moved, removed))
+
+		if len(fileList) == 0:
+			save()
+			return
+
+		status = Status.create(len(fileList), desc = 'Scanning files...', unit = 'file')
+		timestamp = time.time()
+		futures = [pool.submit(scanFile, path, found[path]) for path in fileList]
+
+		try:
+			for future in concurrent.futures.as_completed(futures):
 				status.add(1)
 
-				if not path in files:
-					Print.info('scanning ' + name)
-					nsp = Fs.Nsp(path, None)
-						
-					files[nsp.path] = nsp
-					#files[nsp.path].readMeta()
-
-					i = i + 1
-					if i % 20 == 0:
-						save()
-			except KeyboardInterrupt:
-				status.close()
-				raise
-			except BaseException as e:
-				Print.info('An error occurred processing file: ' + str(e))
-				status.close()
+				try:
+					nsp = future.result()
+				except BaseException as e:
+					Print.info('An error occurred processing file: ' + str(e))
+					continue
+
+				update(nsp)
+		except KeyboardInterrupt:
+			# keep what has been scanned so far, the next scan skips those files
+			for future in futures:
+				future.cancel()
+			save()
+			status.close()
+			raise
+
 		save()
 		status.close()
+
+		elapsed = max(time.time() - timestamp, 0.001)
+		Print.info('scanned %d files in %.1f seconds, %.1f files/s' % (len(fileList), elapsed, len(fileList) / elapsed))
+	except KeyboardInterrupt:
+		raise
 	except BaseException as e:
 		Print.info('An error occurred scanning files: ' + str(e))
+	finally:
+		pool.shutdown(wait = False)
 
 def removeEmptyDir(path, removeRoot=True):
 	if not os.path.isdir(path):
@@ -109,37 +257,106 @@ def load(fileName = 'titledb/files.json'):
 	try:
 		timestamp = time.clock()
 
+		entries = {}
+
 		if os.path.isfile(fileName):
 			with open(fileName, encoding="utf-8-sig") as f:
 				for k in json.loads(f.read()):
-					t = Fs.Nsp(k['path'], None)
-					t.timestamp = k['timestamp']
-					t.titleId = k['titleId']
-					t.version = k['version']
+					entries[k['path']] = k
+
+		# changes recorded since the last snapshot
+		if os.path.isfile(journalFileName(fileName)):
+			with open(journalFileName(fileName), encoding="utf-8") as f:
+				for line in f:
+					try:
+						op = json.loads(line)
+					except ValueError:
+						# torn write from a crash, nothing after it was committed
+						break
 
-					if not t.path:
-						continue
+					if op['op'] == 'remove':
+						entries.pop(op['path'], None)
+					else:
+						entries[op['entry']['path']] = op['entry']
 
-					path = os.path.abspath(t.path)
-					if os.path.isfile(path): 
-						files[path] = t #Fs.Nsp(path, None)
+		for k in entries.values():
+			t = Fs.Nsp(k['path'], None)
+			t.timestamp = k['timestamp']
+			t.titleId = k['titleId']
+			t.version = k['version']
+			t.fileSize = k.get('fileSize')
+			t.fileModified = k.get('fileModified')
+
+			if not t.path:
+				continue
+
+			path = os.path.abspath(t.path)
+			if os.path.isfile(path): 
+				setFile(path, t) #Fs.Nsp(path, None)
+			elif t.fileSize is not None:
+				missing.append(t)
 	except:
 		raise
 	Print.info('loaded file list in ' + str(time.clock() - timestamp) + ' seconds')
 
+def journalFileName(fileName):
+	return fileName + '.journal'
+
+def writeJournal(op, fileName = 'titledb/files.json'):
+	global journal
+	global journalSize
+
+	with lock:
+		if journal is None:
+			journal = open(journalFileName(fileName), 'a', encoding="utf-8")
+
+		journal.write(json.dumps(op, sort_keys=True) + '\n')
+		journal.flush()
+		journalSize += 1
+
+		if journalSize >= compactThreshold:
+			save(fileName)
+
+def update(nsp):
+	# adds or updates a single file and records it in the journal instead of rewriting files.json
+	path = os.path.abspath(nsp.path)
+	op = 'update' if path in files else 'add'
+	# files that did not come from a scan (fresh downloads) have no fingerprint yet, without it the next scan re-parses them
+	nsp.getFileSize()
+	nsp.getFileModified()
+	setFile(path, nsp)
+	writeJournal({'op': op, 'entry': nsp.dict()})
+
+def remove(path):
+	path = os.path.abspath(path)
+	nsp = removeFile(path)
+	writeJournal({'op': 'remove', 'path': nsp.path if nsp else path})
+
 def save(fileName = 'titledb/files.json', map = ['id', 'path', 'version', 'timestamp', 'hasValidTicket']):
-	lock.acquire()
+	# writes a full snapshot and truncates the journal, the snapshot is swapped in atomically
+	global journal
+	global journalSize
 
-	try:
+	with lock:
 		j = []
 		for i,k in files.items():
 			j.append(k.dict())
-		with open(fileName, 'w') as outfile:
+
+		tmpFileName = fileName + '.tmp'
+		with open(tmpFileName, 'w') as outfile:
 			json.dump(j, outfile, indent=4, sort_keys=True)
-	except:
-		lock.release()
-		raise
-	lock.release()
+			outfile.flush()
+			os.fsync(outfile.fileno())
+		os.replace(tmpFileName, fileName)
+
+		if journal is not None:
+			journal.close()
+			journal = None
+
+		# replaying a journal over the newer snapshot is harmless, so a crash before this point loses nothing
+		if os.path.isfile(journalFileName(fileName)):
+			os.remove(journalFileName(fileName))
+		journalSize = 0
 
 if os.path.isfile('files.json'):
 	os.rename('files.json', 'titledb/files.json')
\ No newline at end of file
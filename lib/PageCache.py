@@ -0,0 +1,88 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+import threading
+from collections import OrderedDict
+import Config
+
+# process wide cache of decrypted Fs pages, shared by every partition opened on the same file.
+# keys are (file id, absolute offset, crypto chain), see BufferedFile.pageKey()
+
+global pages
+global size
+global hits
+global misses
+
+pages = OrderedDict()
+size = 0
+hits = 0
+misses = 0
+lock = threading.Lock()
+
+def capacity():
+	return Config.fs.pageCacheSize
+
+def get(key, minSize = 0):
+	global hits
+	global misses
+
+	if key is None or capacity() <= 0:
+		return None
+
+	with lock:
+		page = pages.get(key)
+
+		if page is None or len(page) < minSize:
+			misses += 1
+			return None
+
+		pages.move_to_end(key)
+		hits += 1
+		return page
+
+def put(key, page):
+	global size
+
+	if key is None:
+		return
+
+	limit = capacity()
+
+	# a single huge page (whole file reads) would just flush everything else out
+	if len(page) > limit // 8:
+		return
+
+	if not isinstance(page, bytes):
+		page = bytes(page)
+
+	with lock:
+		old = pages.pop(key, None)
+		if old is not None:
+			size -= len(old)
+
+		pages[key] = page
+		size += len(page)
+
+		while size > limit and pages:
+			k, v = pages.popitem(last = False)
+			size -= len(v)
+
+def invalidate(fileId):
+	global size
+
+	if fileId is None:
+		return
+
+	with lock:
+		for k in [k for k in pages if k[0] == fileId]:
+			size -= len(pages.pop(k))
+
+def clear():
+	global size
+
+	with lock:
+		pages.clear()
+		size = 0
+
+def stats():
+	with lock:
+		return {'hits': hits, 'misses': misses, 'pages': len(pages), 'size': size, 'capacity': capacity()}
@@ -82,6 +82,7 @@ class Status:
 		self.ats = time.clock()
 		self.timestamp = time.clock()
 		self.desc = desc
+		self.lock = threading.Lock()
 
 		if not Config.jsonOutput:
 			self.tqdm = tqdm.tqdm(total=size, unit=unit, unit_scale=True, position = position, desc=desc, leave=False, ascii = True)
@@ -89,16 +90,16 @@ class Status:
 			self.tqdm = None
 
 	def add(self, v=1):
-		#lock.acquire()
-		if self.isOpen():
-			self.i += v
-			self.a += v
-			try:
-				self.tqdm.update(v)
-			except BaseException as e:
-				#self.close()
-				pass
-		#lock.release()
+		# a bar can be fed by several download threads at once
+		with self.lock:
+			if self.isOpen():
+				self.i += v
+				self.a += v
+				try:
+					self.tqdm.update(v)
+				except BaseException as e:
+					#self.close()
+					pass
 
 	def update(self, v=1):
 		self.add(v)
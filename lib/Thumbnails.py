@@ -0,0 +1,101 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+import threading
+import concurrent.futures
+import Titles
+import Nsps
+import Config
+import Print
+
+# downloads and resizes title images on a small worker pool instead of the http request threads.
+# every (id, image, width) is worked on at most once at a time, later callers wait for the running job.
+# precache() works through the library on its own single background thread, one image at a time, so it never
+# queues ahead of the images http requests are waiting for.
+
+global pool
+global inFlight
+pool = None
+inFlight = {}
+lock = threading.RLock()
+
+def getPool():
+	global pool
+
+	with lock:
+		if pool is None:
+			pool = concurrent.futures.ThreadPoolExecutor(max_workers = max(Config.thumbnails.threads, 1))
+		return pool
+
+def render(id, image, width = None):
+	title = Titles.get(id)
+
+	if image == 'icon':
+		return title.iconFile(width) or title.frontBoxArtFile(width)
+	elif image == 'banner':
+		return title.bannerFile(width)
+	elif image == 'frontBoxArt':
+		return title.frontBoxArtFile(width)
+	elif image.startswith('screenshot'):
+		return title.screenshotFile(int(image[10:]), width)
+
+	raise IOError('unknown image ' + image)
+
+def done(key, future):
+	with lock:
+		if inFlight.get(key) is future:
+			del inFlight[key]
+
+def submit(id, image, width = None):
+	key = (id, image, width)
+	p = getPool()
+
+	with lock:
+		future = inFlight.get(key)
+
+		if future is None:
+			future = p.submit(render, id, image, width)
+			inFlight[key] = future
+			future.add_done_callback(lambda f: done(key, f))
+
+	return future
+
+def get(id, image, width = None):
+	# returns the path of the finished image, or None if the title has none
+	return submit(id, image, width).result()
+
+def precache():
+	# renders the library grid thumbnails of every title we have files for, at each configured width
+	ids = set()
+	for path, nsp in list(Nsps.files.items()):
+		if nsp.titleId and Titles.contains(nsp.titleId):
+			baseId = Titles.get(nsp.titleId).baseId
+			if baseId and Titles.contains(baseId):
+				ids.add(baseId)
+
+	keys = [(id, 'icon', width) for id in ids for width in Config.thumbnails.widths]
+	threading.Thread(target = precacheWorker, args = (keys,), daemon = True).start()
+
+	Print.info('precaching %d thumbnails' % len(keys))
+
+def precacheWorker(keys):
+	for key in keys:
+		if not Config.isRunning:
+			return
+
+		with lock:
+			if key in inFlight:
+				# already being rendered for a request
+				continue
+
+			# registered like a pool job, a request for the same image waits for this one instead of rendering it twice
+			future = concurrent.futures.Future()
+			future.set_running_or_notify_cancel()
+			inFlight[key] = future
+
+		try:
+			future.set_result(render(*key))
+		except BaseException as e:
+			future.set_exception(e)
+			Print.error('thumbnail error: ' + str(e))
+		finally:
+			done(key, future)
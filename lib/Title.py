@@ -26,10 +26,6 @@ except ImportError:
 global grabUrlInit
 global urlCache
 global urlLock
-global fileLUT
-
-fileLUT = {}
-
 grabUrlInit = False
 urlCache = {}
 urlLock = threading.Lock()	
@@ -181,15 +177,7 @@ class Title:
 		return '|'.join(r)
 
 	def getFiles(self):
-		if self.id in fileLUT:
-			return fileLUT[self.id]
-
-		fileLUT[self.id] = []
-		for path, f in Nsps.files.items():
-			if(f.titleId == self.id):
-				fileLUT[self.id].append(f)
-
-		return fileLUT[self.id]
+		return Nsps.getFilesByTitleId(self.id)
 
 	def getLatestFile(self):
 		highest = None
@@ -259,7 +247,11 @@ class Title:
 			pass
 
 	def setNsuId(self, nsuId):
+		old = self.nsuId
 		self.nsuId = nsuId
+		if str(nsuId) != str(old):
+			Titles.nsuIdChanged(self, old)
+
 		if nsuId:
 			self.isDemo = str(nsuId)[0:4] == '7003'
 
@@ -438,9 +430,21 @@ class Title:
 		if os.path.isfile(path):
 			return path
 		os.makedirs(base, exist_ok=True)
-		urllib.request.urlretrieve(url, path)
+
+		# written under a temporary name so a concurrent reader never sees a partial image
+		tmpPath = self.tmpPath(path)
+		try:
+			urllib.request.urlretrieve(url, tmpPath)
+			os.replace(tmpPath, path)
+		finally:
+			if os.path.isfile(tmpPath):
+				os.remove(tmpPath)
 		return path
 
+	def tmpPath(self, path):
+		base, name = os.path.split(path)
+		return os.path.join(base, '.%d.%s.tmp' % (threading.get_ident(), name))
+
 	def getResizedImage(self, filePath, width = None, height = None):
 		if not width and not height:
 			return filePath
@@ -457,8 +461,15 @@ class Title:
 			elif width == None:
 				width = int(height * ar)
 
-			out = im.resize((width, height), Image.ANTIALIAS)
-			out.save(path, quality=100)
+			out = im.resize((width, height), Image.LANCZOS)
+
+			tmpPath = self.tmpPath(path)
+			try:
+				out.save(tmpPath, format=im.format, quality=100)
+				os.replace(tmpPath, path)
+			finally:
+				if os.path.isfile(tmpPath):
+					os.remove(tmpPath)
 
 		return path
 
@@ -17,6 +17,15 @@ titles = None
 global regionTitles
 regionTitles = {}
 
+# (region, language) -> [map, len(map), {nsuId: title}], rebuilt whenever the map grew behind our back
+# and patched in place when a title's nsuId changes (nsuIdChanged)
+global nsuIdIndex
+nsuIdIndex = {}
+
+# bumped whenever the title database changes, lets callers cache anything derived from it
+global generation
+generation = 0
+
 if os.path.isfile('titles.json'):
 	os.rename('titles.json', 'titledb/titles.json')
 
@@ -53,39 +62,74 @@ def get(key, region = None, language = None):
 		t = Title.Title()
 		t.setId(key)
 		data(region, language)[key] = t
+		changed()
 	return data(region, language)[key]
 
+def nsuIds(region, language):
+	map = data(region, language)
+	key = (region, language)
+
+	if not key in nsuIdIndex or nsuIdIndex[key][0] is not map or nsuIdIndex[key][1] != len(map):
+		index = {}
+		for t in map.values():
+			try:
+				if t.nsuId:
+					index.setdefault(int(t.nsuId), t)
+			except (ValueError, TypeError):
+				pass
+		nsuIdIndex[key] = [map, len(map), index]
+
+	return nsuIdIndex[key][2]
+
 def getNsuid(id, region, language):
 	id = int(id)
 
-	map = data(region, language)
+	index = nsuIds(region, language)
 
-	for t in map:
-		if map[t].nsuId == id:
-			return map[t]
+	if id in index:
+		return index[id]
 
 	title = Title.Title()
 	title.nsuId = id
 
+	map = data(region, language)
 	map[id] = title
+	index[id] = title
+	nsuIdIndex[(region, language)][1] = len(map)
 	return title
 
 def hasNsuid(id, region, language):
-	id = int(id)
+	return int(id) in nsuIds(region, language)
 
-	map = data(region, language)
+def nsuIdChanged(title, old):
+	# called by Title.setNsuId, fixes up the index of every region map holding the title
+	for map, n, index in nsuIdIndex.values():
+		if not any(map.get(k) is title for k in (title.id, title.nsuId, old)):
+			continue
 
-	for t in map:
-		if map[t].nsuId == id:
-			return True
+		try:
+			if index.get(int(old)) is title:
+				del index[int(old)]
+		except (ValueError, TypeError):
+			pass
 
-	return False
+		try:
+			if title.nsuId:
+				index.setdefault(int(title.nsuId), title)
+		except (ValueError, TypeError):
+			pass
+	changed()
 	
 def contains(key, region = None):
 	return key in titles
 	
 def set(key, value):
 	titles[key] = value
+	changed()
+
+def changed():
+	global generation
+	generation += 1
 	
 	
 def keys(region = None, language = None):
@@ -135,6 +179,8 @@ def loadTitleBuffer(buffer, silent = False):
 		if not silent and titleKey != titles[t.id].key:
 			Print.info('Added new title key for ' + str(titles[t.id].name) + '[' + str(t.id) + ']')
 
+	changed()
+
 confLock = threading.Lock()
 
 def loadTitlesJson(filePath = 'titledb/titles.json'):
@@ -181,6 +227,7 @@ def load():
 	except BaseException as e:
 		Print.error('title load error: ' + str(e))
 		'''
+	changed()
 	confLock.release()
 	loadTxtDatabases()
 
@@ -229,6 +276,9 @@ def saveTitlesJson(newTitles, fileName = 'titledb/titles.json'):
 	confLock.release()
 
 def save(fileName = 'titledb/titles.json'):
+	# titles are updated in place all over the place, they are always saved afterwards
+	changed()
+
 	confLock.acquire()
 	try:
 		j = {}
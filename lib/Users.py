@@ -1,10 +1,30 @@
 import os
 import re
+import time
+import hmac
+import base64
+import threading
+from collections import OrderedDict
 import Print
 
 global users
 users = {}
 
+# (Authorization header, address) -> (user, expires), so a request costs one lookup instead of a decode and auth()
+global cache
+cache = OrderedDict()
+cacheSize = 1024
+cacheTtl = 10
+cacheLock = threading.Lock()
+
+# users.conf is stat'ed at most every cacheTtl seconds and reloaded when it changed
+global confPath
+global confMtime
+global confChecked
+confPath = 'conf/users.conf'
+confMtime = None
+confChecked = 0
+
 class User:
 	def __init__(self):
 		self.id = None
@@ -86,16 +106,76 @@ def auth(id, password, address):
 	if user.remoteAddr and user.remoteAddr != address:
 		return None
 
-	if user.password != password:
+	if user.password is None or not hmac.compare_digest(user.password.encode('utf-8'), password.encode('utf-8')):
 		return None
 
 	return user
 
+def authHeader(header, address):
+	# authenticates a Basic Authorization header, returns the user or None
+	if not header:
+		return None
+
+	now = time.time()
+	refresh(now)
+
+	key = (header, address)
+
+	with cacheLock:
+		hit = cache.get(key)
+		if hit and hit[1] > now:
+			cache.move_to_end(key)
+			return hit[0]
+
+	try:
+		id, password = base64.b64decode(header.split(' ')[1]).decode().split(':')
+		user = auth(id, password, address)
+	except:
+		user = None
+
+	with cacheLock:
+		cache[key] = (user, now + cacheTtl)
+		cache.move_to_end(key)
+
+		while len(cache) > cacheSize:
+			cache.popitem(last = False)
+
+	return user
+
+def refresh(now = None):
+	global confChecked
+
+	now = now or time.time()
+
+	if now - confChecked < cacheTtl:
+		return
+
+	confChecked = now
+
+	try:
+		mtime = os.stat(confPath).st_mtime_ns
+	except OSError:
+		mtime = None
+
+	if mtime != confMtime:
+		load(confPath)
+
 def load(path = 'conf/users.conf'):
+	global users
+	global confPath
+	global confMtime
+
+	confPath = path
+
+	try:
+		confMtime = os.stat(path).st_mtime_ns
+	except OSError:
+		confMtime = None
+
 	if not os.path.isfile(path):
 		return
 
-	global users
+	newUsers = {}
 	firstLine = True
 	map = ['id', 'password', 'isAdmin', 'remoteAddr', 'requireAuth', 'switchHost', 'switchPort']
 	with open(path, encoding="utf-8-sig") as f:
@@ -112,10 +192,15 @@ def load(path = 'conf/users.conf'):
 			t = User()
 			t.loadCsv(line, map)
 
-			users[t.id] = t
+			newUsers[t.id] = t
 
 			Print.info('loaded user ' + str(t.id))
 
+	users = newUsers
+
+	with cacheLock:
+		cache.clear()
+
 def save():
 	pass
 
@@ -1,5 +1,7 @@
-# Pure python AES128 implementation
-# SciresM, 2017
+# AES128 backend facade: native AES via cryptography / pycryptodome when
+# available, falling back to the pure python implementation.
+# Pure python implementation: SciresM, 2017
+import os
 from struct import unpack as up, pack as pk
 from binascii import hexlify as hx, unhexlify as uhx
 
@@ -7,11 +9,16 @@ def sxor(s1, s2):
 	assert(len(s1) == len(s2))
 	return b''.join([pk('B', x ^ y) for x,y in zip(s1, s2)])
 
-class AESCBC:
+def bxor(s1, s2):
+	'''XORs two equally sized buffers in one big integer operation.'''
+	assert(len(s1) == len(s2))
+	return (int.from_bytes(s1, 'little') ^ int.from_bytes(s2, 'little')).to_bytes(len(s1), 'little')
+
+class PyAESCBC:
 	'''Class for performing AES CBC cipher operations.'''
 
 	def __init__(self, key, iv):
-		self.aes = AESECB(key)
+		self.aes = PyAESECB(key)
 		if len(iv) != self.aes.block_size:
 			raise ValueError('IV must be of size %X!' % self.aes.block_size)
 		self.iv = iv
@@ -47,11 +54,11 @@ class AESCBC:
 			raise ValueError('IV must be of size %X!' % self.aes.block_size)
 		self.iv = iv
 
-class AESCTR:
+class PyAESCTR:
 	'''Class for performing AES CTR cipher operations.'''
 
 	def __init__(self, key, ctr):
-		self.aes = AESECB(key)
+		self.aes = PyAESECB(key)
 		if len(ctr) != self.aes.block_size:
 			raise ValueError('CTR must be of size %X!' % self.aes.block_size)
 		self.ctr = int(hx(ctr), 0x10)
@@ -62,18 +69,16 @@ class AESCTR:
 			ctr = self.ctr
 		elif type(ctr) is not int:
 			ctr = int(hx(ctr), 16)
-		out = b''
-		ln = len(data)
-		while ln:
-			xorpad = self.aes.encrypt_block_ecb(uhx('%032X' % ctr))
-			l = min(0x10, ln)
-			out += sxor(data[:l], xorpad[:l])
-			data = data[l:]
-			ln -= l
-			ctr += 1
-		self.ctr = ctr
+		blocks = (len(data) + 0xF) // 0x10
+		out = bxor(data, self.keystream(ctr, blocks)[:len(data)])
+		self.ctr = ctr + blocks
 		return out
 
+	def keystream(self, ctr, blocks):
+		'''Generates the CTR keystream for a run of blocks in one pass.'''
+		mask = (1 << 128) - 1
+		return b''.join([self.aes.encrypt_block_ecb(((ctr + i) & mask).to_bytes(0x10, 'big')) for i in range(blocks)])
+
 	def decrypt(self, data, ctr=None):
 		'''Decrypts some data in CTR mode.
 		   This is identical to encryption, because CTR mode is symmetric.
@@ -85,15 +90,15 @@ class AESCTR:
 			raise ValueError('CTR must be of size %X!' % self.aes.block_size)
 		self.ctr = int(hx(ctr), 0x10)
 
-class AESXTS:
+class PyAESXTS:
 	'''Class for performing AES XTS cipher operations'''
 
 	def __init__(self, keys, sector=0):
 		self.keys = keys[:16], keys[16:]
 		if not(type(self.keys) is tuple and len(self.keys) == 2):
 			raise TypeError('XTS mode requires a tuple of two keys.')
-		self.K1 = AESECB(self.keys[0])
-		self.K2 = AESECB(self.keys[1])
+		self.K1 = PyAESECB(self.keys[0])
+		self.K2 = PyAESECB(self.keys[1])
 
 		self.sector = sector
 		self.block_size = self.K1.block_size
@@ -169,14 +174,14 @@ class AESXTS:
 	def set_sector(self, sector):
 		self.sector = sector
 
-class AESXTSN:
+class PyAESXTSN:
 	'''Class for performing Nintendo AES XTS cipher operations'''
 
 	def __init__(self, keys, sector_size=0x200, sector=0):
 		if not(type(keys) is tuple and len(keys) == 2):
 			raise TypeError('XTS mode requires a tuple of two keys.')
-		self.K1 = AESECB(keys[0])
-		self.K2 = AESECB(keys[1])
+		self.K1 = PyAESECB(keys[0])
+		self.K2 = PyAESECB(keys[1])
 		self.keys = keys
 		self.sector = sector
 		self.sector_size = sector_size
@@ -254,7 +259,7 @@ class AESXTSN:
 	def set_sector_size(self, sector_size):
 		self.sector_size = sector_size
 
-class AESECB:
+class PyAESECB:
 	'''Class for performing AES ECB cipher operations.'''
 
 	# Constants for performing AES operations -- rcon table, S boxes.
@@ -434,3 +439,293 @@ class AESECB:
 		num_pad = self.block_size - len(block)
 		right = (chr(num_pad) * num_pad).encode()
 		return block + right
+
+
+# Native backends
+#
+# The classes below wrap AES primitives from the cryptography or pycryptodome
+# packages while exposing the same interface as the pure python classes above.
+# AESECB / AESCBC / AESCTR / AESXTS / AESXTSN are bound to whichever backend is
+# selected by set_backend().
+
+backends = []
+
+try:
+	from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+	from cryptography.hazmat.backends import default_backend
+	backends.append('cryptography')
+except ImportError:
+	pass
+
+try:
+	from Crypto.Cipher import AES as CryptoAES
+	backends.append('pycryptodome')
+except ImportError:
+	try:
+		from Cryptodome.Cipher import AES as CryptoAES
+		backends.append('pycryptodome')
+	except ImportError:
+		pass
+
+backends.append('python')
+backend = None
+
+def _ecb(key, lib):
+	if lib == 'cryptography':
+		cipher = Cipher(algorithms.AES(key), modes.ECB(), backend=default_backend())
+		return cipher.encryptor().update, cipher.decryptor().update
+	return CryptoAES.new(key, CryptoAES.MODE_ECB).encrypt, CryptoAES.new(key, CryptoAES.MODE_ECB).decrypt
+
+def _cbc(key, iv, lib):
+	if lib == 'cryptography':
+		cipher = Cipher(algorithms.AES(key), modes.CBC(iv), backend=default_backend())
+		return cipher.encryptor().update, cipher.decryptor().update
+	return CryptoAES.new(key, CryptoAES.MODE_CBC, iv=iv).encrypt, CryptoAES.new(key, CryptoAES.MODE_CBC, iv=iv).decrypt
+
+def _ctr(key, ctr, lib):
+	iv = (ctr & ((1 << 128) - 1)).to_bytes(0x10, 'big')
+	if lib == 'cryptography':
+		return Cipher(algorithms.AES(key), modes.CTR(iv), backend=default_backend()).encryptor().update
+	return CryptoAES.new(key, CryptoAES.MODE_CTR, nonce=b'', initial_value=iv).encrypt
+
+def _xts_mask(tweak, blocks):
+	'''Expands an encrypted tweak into the XEX mask for a run of blocks.'''
+	t = int.from_bytes(tweak, 'little')
+	mask = []
+	for i in range(blocks):
+		mask.append(t.to_bytes(0x10, 'little'))
+		t <<= 1
+		if t & (1 << 128):
+			t ^= ((1 << 128) | (0x87))
+	return b''.join(mask)
+
+class NativeAESECB:
+	'''Class for performing AES ECB cipher operations with a native backend.'''
+
+	def __init__(self, key, lib=None):
+		self.block_size = 0x10
+		if len(key) != self.block_size:
+			raise ValueError('Key must be of size %X!' % self.block_size)
+		self.backend = lib or backend
+		self._encrypt, self._decrypt = _ecb(bytes(key), self.backend)
+
+	def encrypt(self, data):
+		'''Encrypts some data in ECB mode.'''
+		return self._encrypt(self.pad_block(data))
+
+	def decrypt(self, data):
+		'''Decrypts some data in EBC mode.'''
+		if len(data) % self.block_size:
+			raise ValueError('Data is not aligned to block size!')
+		return self._decrypt(data)
+
+	def encrypt_block_ecb(self, block):
+		assert(len(block) <= self.block_size)
+		return self._encrypt(self.pad_block(block))
+
+	def decrypt_block_ecb(self, block):
+		assert(len(block) == self.block_size)
+		return self._decrypt(block)
+
+	def pad_block(self, data):
+		'''Pads the trailing partial block using CMS padding, like PyAESECB.'''
+		num_pad = -len(data) % self.block_size
+		if not num_pad:
+			return data
+		return bytes(data) + bytes([num_pad]) * num_pad
+
+class NativeAESCBC:
+	'''Class for performing AES CBC cipher operations with a native backend.'''
+
+	def __init__(self, key, iv, lib=None):
+		self.aes = NativeAESECB(key, lib)
+		self.key = bytes(key)
+		if len(iv) != self.aes.block_size:
+			raise ValueError('IV must be of size %X!' % self.aes.block_size)
+		self.iv = iv
+
+	def encrypt(self, data, iv=None):
+		'''Encrypts some data in CBC mode.'''
+		if len(data) % self.aes.block_size:
+			raise ValueError('Data is not aligned to block size!')
+		return _cbc(self.key, bytes(iv or self.iv), self.aes.backend)[0](data)
+
+	def decrypt(self, data, iv=None):
+		'''Decrypts some data in CBC mode.'''
+		if len(data) % self.aes.block_size:
+			raise ValueError('Data is not aligned to block size!')
+		return _cbc(self.key, bytes(iv or self.iv), self.aes.backend)[1](data)
+
+	def set_iv(self, iv):
+		if len(iv) != self.aes.block_size:
+			raise ValueError('IV must be of size %X!' % self.aes.block_size)
+		self.iv = iv
+
+class NativeAESCTR:
+	'''Class for performing AES CTR cipher operations with a native backend.'''
+
+	def __init__(self, key, ctr, lib=None):
+		self.aes = NativeAESECB(key, lib)
+		self.key = bytes(key)
+		if len(ctr) != self.aes.block_size:
+			raise ValueError('CTR must be of size %X!' % self.aes.block_size)
+		self.ctr = int(hx(ctr), 0x10)
+
+	def encrypt(self, data, ctr=None):
+		'''Encrypts some data in CTR mode.'''
+		if ctr is None:
+			ctr = self.ctr
+		elif type(ctr) is not int:
+			ctr = int(hx(ctr), 16)
+		out = _ctr(self.key, ctr, self.aes.backend)(data)
+		self.ctr = ctr + (len(data) + 0xF) // 0x10
+		return out
+
+	def decrypt(self, data, ctr=None):
+		'''Decrypts some data in CTR mode.
+		   This is identical to encryption, because CTR mode is symmetric.
+		'''
+		return self.encrypt(data, ctr)
+
+	def set_ctr(self, ctr):
+		if len(ctr) != self.aes.block_size:
+			raise ValueError('CTR must be of size %X!' % self.aes.block_size)
+		self.ctr = int(hx(ctr), 0x10)
+
+class NativeAESXTSN:
+	'''Class for performing Nintendo AES XTS cipher operations with a native backend'''
+
+	def __init__(self, keys, sector_size=0x200, sector=0, lib=None):
+		if not(type(keys) is tuple and len(keys) == 2):
+			raise TypeError('XTS mode requires a tuple of two keys.')
+		self.K1 = NativeAESECB(keys[0], lib)
+		self.K2 = NativeAESECB(keys[1], lib)
+		self.keys = keys
+		self.sector = sector
+		self.sector_size = sector_size
+		self.block_size = self.K1.block_size
+
+	def get_mask(self, size, sector):
+		'''Builds the XEX mask for size bytes starting at sector.'''
+		mask = []
+		while size > 0:
+			n = min(self.sector_size, size)
+			mask.append(_xts_mask(self.K2.encrypt_block_ecb(self.get_tweak(sector).to_bytes(0x10, 'big')), n // 0x10))
+			size -= n
+			sector += 1
+		return b''.join(mask)
+
+	def encrypt(self, data, sector=None):
+		if sector is None:
+			sector = self.sector
+		if len(data) % self.block_size:
+			raise ValueError('Data is not aligned to block size!')
+		mask = self.get_mask(len(data), sector)
+		return bxor(self.K1.encrypt(bxor(data, mask)), mask)
+
+	def encrypt_sector(self, data, tweak):
+		if len(data) % self.block_size:
+			raise ValueError('Data is not aligned to block size!')
+		mask = _xts_mask(self.K2.encrypt_block_ecb(tweak.to_bytes(0x10, 'big')), len(data) // 0x10)
+		return bxor(self.K1.encrypt(bxor(data, mask)), mask)
+
+	def decrypt(self, data, sector=None):
+		if sector is None:
+			sector = self.sector
+		if len(data) % self.block_size:
+			raise ValueError('Data is not aligned to block size!')
+		mask = self.get_mask(len(data), sector)
+		return bxor(self.K1.decrypt(bxor(data, mask)), mask)
+
+	def decrypt_sector(self, data, tweak):
+		if len(data) % self.block_size:
+			raise ValueError('Data is not aligned to block size!')
+		mask = _xts_mask(self.K2.encrypt_block_ecb(tweak.to_bytes(0x10, 'big')), len(data) // 0x10)
+		return bxor(self.K1.decrypt(bxor(data, mask)), mask)
+
+	def get_tweak(self, sector=None):
+		'''Gets tweak for use in XEX.'''
+		if sector is None:
+			sector = self.sector
+		tweak = 0
+		for i in range(self.block_size):
+			tweak |= (sector & 0xFF) << (i * 8)
+			sector >>= 8
+		return tweak
+
+	def set_sector(self, sector):
+		self.sector = sector
+
+	def set_sector_size(self, sector_size):
+		self.sector_size = sector_size
+
+class NativeAESXTS(NativeAESXTSN):
+	'''Class for performing AES XTS cipher operations with a native backend'''
+
+	def __init__(self, keys, sector=0, lib=None):
+		super(NativeAESXTS, self).__init__((keys[:16], keys[16:]), 0x200, sector, lib)
+
+def set_backend(name = None):
+	'''Selects the implementation exported as AESECB / AESCBC / AESCTR / AESXTS / AESXTSN.
+	   Defaults to the fastest available backend.
+	'''
+	global backend, AESECB, AESCBC, AESCTR, AESXTS, AESXTSN
+
+	if name is None:
+		name = backends[0]
+
+	if name not in backends:
+		raise ValueError('AES backend not available: ' + str(name))
+
+	backend = name
+
+	if backend == 'python':
+		AESECB, AESCBC, AESCTR, AESXTS, AESXTSN = PyAESECB, PyAESCBC, PyAESCTR, PyAESXTS, PyAESXTSN
+	else:
+		AESECB, AESCBC, AESCTR, AESXTS, AESXTSN = NativeAESECB, NativeAESCBC, NativeAESCTR, NativeAESXTS, NativeAESXTSN
+
+	return backend
+
+def self_test(name = None, rounds = 4):
+	'''Checks that a native backend gives byte identical output to the pure python implementation.'''
+	name = name or backend
+
+	if name == 'python':
+		return True
+
+	for i in range(rounds):
+		key = os.urandom(0x10)
+		keys = os.urandom(0x20)
+		iv = os.urandom(0x10)
+		ctr = int.from_bytes(os.urandom(0x10), 'big') | 0xFF
+		data = os.urandom(0x230 + i * 0x10)
+		sector = int.from_bytes(os.urandom(2), 'little')
+
+		results = [
+			(PyAESECB(key).encrypt(data), NativeAESECB(key, name).encrypt(data)),
+			(PyAESECB(key).encrypt(data[:-3]), NativeAESECB(key, name).encrypt(data[:-3])),
+			(PyAESECB(key).decrypt(data), NativeAESECB(key, name).decrypt(data)),
+			(PyAESCBC(key, iv).encrypt(data), NativeAESCBC(key, iv, name).encrypt(data)),
+			(PyAESCBC(key, iv).decrypt(data), NativeAESCBC(key, iv, name).decrypt(data)),
+			(PyAESCTR(key, iv).encrypt(data[:-5], ctr), NativeAESCTR(key, iv, name).encrypt(data[:-5], ctr)),
+			(PyAESXTS(keys).encrypt(data, sector), NativeAESXTS(keys, 0, name).encrypt(data, sector)),
+			(PyAESXTS(keys).decrypt(data, sector), NativeAESXTS(keys, 0, name).decrypt(data, sector)),
+			(PyAESXTSN((keys[:16], keys[16:]), 0x100).decrypt(data, sector), NativeAESXTSN((keys[:16], keys[16:]), 0x100, 0, name).decrypt(data, sector)),
+		]
+
+		for py, native in results:
+			if py != native:
+				return False
+
+		a = PyAESCTR(key, iv)
+		b = NativeAESCTR(key, iv, name)
+		if a.encrypt(data[:0x25]) + a.encrypt(data[0x25:]) != b.encrypt(data[:0x25]) + b.encrypt(data[0x25:]) or a.ctr != b.ctr:
+			return False
+
+	return True
+
+set_backend()
+
+if __name__ == '__main__':
+	for name in backends:
+		print('%s: %s' % (name, 'OK' if self_test(name) else 'MISMATCH'))
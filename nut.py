@@ -19,6 +19,7 @@ sys.path.insert(0, 'lib')
 from Title import Title
 import Titles
 import Nsps
+import Thumbnails
 import CDNSP
 import Fs
 import Config
@@ -121,15 +122,12 @@ def updateDb(url):
 global status
 status = None
 
-global scrapeThreads
-scrapeThreads = 16
-
 def scrapeThread(id, delta = True):
-	size = len(Titles.titles) // scrapeThreads
+	size = len(Titles.titles) // Config.scrapeThreads
 	st = Status.create(size, 'Thread ' + str(id))
 	for i,titleId in enumerate(Titles.titles.keys()):
 		try:
-			if (i - id) % scrapeThreads == 0:
+			if (i - id) % Config.scrapeThreads == 0:
 				Titles.get(titleId).scrape(delta)
 				st.add()
 		except BaseException as e:
@@ -153,8 +151,7 @@ def downloadThread(i):
 				if os.path.isfile(path):
 					nsp = Fs.Nsp(path, None)
 					nsp.move()
-					Nsps.files[nsp.path] = nsp
-					Nsps.save()
+					Nsps.update(nsp)
 					status.add()
 				activeDownloads[i] = 0
 			else:
@@ -253,7 +250,7 @@ def startDlcScan(queue):
 	dlcStatus = Status.create(queue.size() * 0x200, 'DLC Scan')
 	#scanDLC(id)
 	threads = []
-	for i in range(scrapeThreads):
+	for i in range(Config.scrapeThreads):
 		t = threading.Thread(target=scanDLCThread, args=[queue, dlcStatus])
 		t.start()
 		threads.append(t)
@@ -296,7 +293,7 @@ def startBaseScan():
 	baseStatus = Status.create(pow(2,28), 'Base Scan')
 
 	threads = []
-	for i in range(scrapeThreads):
+	for i in range(Config.scrapeThreads):
 		t = threading.Thread(target=scanBaseThread, args=[baseStatus])
 		t.start()
 		threads.append(t)
@@ -876,7 +873,7 @@ if __name__ == '__main__':
 			initFiles()
 
 			threads = []
-			for i in range(scrapeThreads):
+			for i in range(Config.scrapeThreads):
 				t = threading.Thread(target=scrapeThread, args=[i, args.scrape_delta])
 				t.start()
 				threads.append(t)
@@ -935,6 +932,7 @@ if __name__ == '__main__':
 			startDownloadThreads()
 			initTitles()
 			initFiles()
+			Thumbnails.precache()
 			Server.run()
 
 		if args.blockchain: